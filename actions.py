@@ -25,17 +25,59 @@ def pretty_print(val,err,extra_err_digits = 1):
         digits -= 1
     return "{0:.{1}f}({2})".format(val, digits, err)
 
+def settings(arg_dict):
+    """Settings of the estimator, as stored along with the results."""
+    engine = arg_dict.get('engine', 'puwr')
+    if engine == "puwr":
+        return {"estimator" : "puwr.tauint"}
+    return {"estimator" : engine, "S" : 1.5}
+
+def cached(label, d, o, arg_dict):
+    """Look up the result of :func:`estimate` in the results store
+    ``arg_dict['store']``. Returns ``None`` if it is not known or
+    there is no store."""
+    if not arg_dict.get('store') or arg_dict.get('uwplot'):
+        return None
+    return arg_dict['store'].estimate(label, o, d.ncut,
+                                      settings(arg_dict), d.signature,
+                                      d.sample)
+
+def estimate(label, d, o, arg_dict):
+    """Estimate the mean value, its error, the integrated
+    autocorrelation time and its error for order ``o`` of the data
+    ``d``, using the estimator ``arg_dict['engine']`` (see
+    :data:`engines`). Results computed before can be passed in
+    ``arg_dict['estimates']``, by ``(label, o)``. Results are taken
+    from and saved to the results store ``arg_dict['store']``, if
+    given."""
+    estimates = arg_dict.get('estimates') or {}
+    if (label, o) in estimates:
+        return estimates[label, o]
+    result = cached(label, d, o, arg_dict)
+    if result is None:
+        engine = engines[arg_dict.get('engine', 'puwr')]
+        result = engine(d.data, o, plots=arg_dict['uwplot'])
+        if arg_dict.get('store'):
+            arg_dict['store'].save_estimate(label, o, d.ncut,
+                                            settings(arg_dict),
+                                            d.signature, result,
+                                            d.sample)
+    return result
+
+def show_label(label, d, arg_dict):
+    """Like :func:`show`, but for the data of a single label."""
+    print "* label:", label
+    for o in arg_dict["orders"]:
+        print "   * order:", o
+        mean, delta, tint, dtint = estimate(label, d, o, arg_dict)
+        print "      mean:", pretty_print(mean, delta)
+        print "      tint:", pretty_print(tint, dtint)
+
 def show(data, arg_dict):
     """Display the mean value, estimated auto-correlaton and error
     thereof."""
     for label in sorted(data.keys()):
-        print "* label:", label
-        for o in arg_dict["orders"]:
-            print "   * order:", o
-            mean, delta, tint, dtint = tauint(data[label].data, 
-                                              o, plots=arg_dict['uwplot'])
-            print "      mean:", pretty_print(mean, delta)
-            print "      tint:", pretty_print(tint, dtint)
+        show_label(label, data[label], arg_dict)
                                           
 class ContinuumLimit(object):
     """Class to estimate continuum limits, as presented in [hep-lat/9911018].
@@ -163,18 +205,31 @@ def extrapolate(data, arg_dict, f = (lambda x: 1., lambda x: x)):
     # if not, do the extrapolation for all lattice sizes
     if not arg_dict['L_sizes']:
         arg_dict['L_sizes'] = sorted(set([d.L for d in data.values()]))
+    # observables are extrapolated separately, for the lattice sizes
+    # for which they were measured
+    present = set((d.L, d.observable) for d in data.values())
+    observables = sorted(set(obs for L, obs in present))
+    # forget data from previous calls
+    for plt in arg_dict["mk_plots"]:
+        for l in plt.data, plt.cl, plt.fit, plt.labels:
+            del l[:]
     for o in arg_dict["orders"]:
         print "  * order = g^" + str(o)
         x, y, dy, cl, dcl, ffn = [], [], [], [], [], []
-        for L in arg_dict['L_sizes']:
+        for L, obs in ((L, obs) for L in arg_dict['L_sizes']
+                       for obs in observables if (L, obs) in present):
             print "    * L =", L
+            if obs is not None:
+                print "    * observable:", obs
+            labels = []
             [i.append([]) for i in x, y, dy]
             for label in data:
-                if data[label].L != L:
+                if data[label].L != L or data[label].observable != obs:
                     continue
                 print "    ** label:", label
                 mean, delta, tint, dtint = \
-                    tauint(data[label].data, o, plots=arg_dict['uwplot'])
+                    estimate(label, data[label], o, arg_dict)
+                labels.append(label)
                 x[-1].append(data[label].tau)
                 y[-1].append(mean)
                 dy[-1].append(delta)
@@ -193,14 +248,174 @@ def extrapolate(data, arg_dict, f = (lambda x: 1., lambda x: x)):
             assert(abs((dcl[-1] - sa)/sa) < 1e-12)
             print "      cl:", pretty_print(cl[-1], dcl[-1])
             print "      " + "*"*50
+            fnx = np.linspace(0, max(x[-1]), 100)
+            fny = [ffn[-1](i) for i in fnx]
+            if arg_dict.get('store'):
+                arg_dict['store'].save_extrapolation(
+                    o, L, labels, x[-1], y[-1], dy[-1],
+                    np.array(coeffs).ravel(), np.array(errors).ravel(),
+                    (fnx, fny), settings(arg_dict),
+                    data[labels[0]].sample,
+                    [data[l].signature for l in labels])
 
             for plt in (p for p in arg_dict["mk_plots"]
                         if L in p.L and o in p.orders):
                 plt.data.append((x[-1], y[-1], dy[-1]))
                 plt.cl.append((cl[-1], dcl[-1]))
-                fnx = np.linspace(0, max(x[-1]), 100)
-                plt.fit.append((fnx, [ffn[-1](i) for i in fnx]))
-                plt.labels.append("$L = {0}$".format(L))
+                plt.fit.append((fnx, fny))
+                plt.labels.append("$L = {0}$".format(L) if obs is None
+                                  else "$L = {0}$, {1}".format(L, obs))
     for plt in arg_dict["mk_plots"]:
         mk_plot(plt)
 
+def autocorrelation(data):
+    """Estimate the autocorrelation function :math:`\Gamma(t)` of
+    replicated data, as in [hep-lat/0306017], using FFTs.
+
+    :param data: Array of shape ``(nrep, N)``.
+    :returns: ``(mean, gamma)``, where ``gamma[t]`` is
+      :math:`\Gamma(t)` for :math:`t = 0, \ldots, N/2`.
+    """
+    nrep, n = data.shape
+    mean = data.mean()
+    size = 2**int(np.ceil(np.log2(2 * n)))
+    f = np.fft.rfft(data - mean, size, axis = 1)
+    wmax = n / 2
+    gamma = np.fft.irfft(abs(f)**2, size, axis = 1)[:, :wmax + 1]\
+        .sum(axis = 0)
+    gamma /= nrep * (n - np.arange(wmax + 1))
+    return mean, gamma
+
+def windows(gamma, N, S):
+    """Apply the automatic windowing procedure of [hep-lat/0306017]
+    for all values of ``S`` at once.
+
+    :param gamma: Autocorrelation function, see
+      :func:`autocorrelation`.
+    :param N: Total number of measurements.
+    :param S: Array of values for the parameter :math:`S`.
+    :returns: Arrays ``(W, delta, tint, dtint)`` with the window, the
+      error of the mean, the integrated autocorrelation time and its
+      error for each value of ``S``.
+
+    For an exponential autocorrelation function, the window grows with
+    ``S``, and ``tint`` is close to its exact value 3/2 once the
+    window covers the decay::
+
+      >>> gamma = 0.5**np.arange(501)
+      >>> W, delta, tint, dtint = windows(gamma, 1000, [0.5, 1, 2, 4])
+      >>> W.tolist()
+      [3, 6, 11, 19]
+      >>> np.round(tint, 2).tolist()
+      [1.38, 1.5, 1.53, 1.55]
+
+    Each value of ``S`` gives the same as a separate call::
+
+      >>> windows(gamma, 1000, 2)[0].tolist()
+      [11]
+    """
+    S = np.atleast_1d(S)[:, np.newaxis]
+    W = np.arange(1, len(gamma))
+    sums = np.cumsum(gamma[1:])
+    tint = 0.5 + sums / gamma[0]
+    # tau(W) from tint(W), small if there are no autocorrelations
+    tau = np.ones_like(tint) * 1e-6
+    tau[tint > 0.5] = 1. / np.log((2 * tint[tint > 0.5] + 1)
+                                  / (2 * tint[tint > 0.5] - 1))
+    g = np.exp(-W / (S * tau)) - S * tau / np.sqrt(W * float(N))
+    # first window with g < 0, the largest one if there is none
+    negative = g < 0
+    i = np.where(negative.any(axis = 1), negative.argmax(axis = 1),
+                 len(W) - 1)
+    W = W[i]
+    CF = gamma[0] + 2 * sums[i]
+    # bias correction, Gamma(t) -> Gamma(t) + CF / N
+    gamma0 = gamma[0] + CF / N
+    CF *= 1 + (2 * W + 1) / float(N)
+    tint = 0.5 * CF / gamma0
+    delta = np.sqrt(CF / N)
+    dtint = 2 * tint * np.sqrt(np.maximum(W + 0.5 - tint, 0) / N)
+    return W, delta, tint, dtint
+
+def gamma_method(data, o, plots = False, S = 1.5):
+    r"""Estimate the mean value, its error, the integrated
+    autocorrelation time and its error with :func:`autocorrelation`
+    and :func:`windows`. The arguments and results are as for
+    :func:`puwr.tauint`, ``plots`` is ignored.
+
+    Uncorrelated data have :math:`\tau_{\rm int} = 1/2`, and the error
+    of the mean is the naive one::
+
+      >>> rng = np.random.RandomState(1)
+      >>> data = rng.normal(size = (1, 4, 10000))
+      >>> mean, delta, tint, dtint = gamma_method(data, 0)
+      >>> abs(tint - 0.5) < 2 * dtint
+      True
+      >>> abs(delta / (data.std() / np.sqrt(data.size)) - 1) < 0.05
+      True
+
+    An AR(1) process :math:`x_{t+1} = \rho x_t + \epsilon_t` has
+    :math:`\Gamma(t) \propto \rho^t` and :math:`\tau_{\rm int} = (1 +
+    \rho) / (2 (1 - \rho))`, i.e. 3/2 for :math:`\rho = 1/2`::
+
+      >>> from scipy.signal import lfilter
+      >>> x = lfilter([1], [1, -0.5], rng.normal(size = (4, 20000)))
+      >>> mean, gamma = autocorrelation(x)
+      >>> np.round(gamma[:4] / gamma[0], 1).tolist()
+      [1.0, 0.5, 0.2, 0.1]
+      >>> mean, delta, tint, dtint = gamma_method(x[np.newaxis], 0)
+      >>> abs(tint - 1.5) < 2 * dtint
+      True
+    """
+    mean, gamma = autocorrelation(data[o])
+    W, delta, tint, dtint = windows(gamma, data[o].size, S)
+    return mean, delta[0], tint[0], dtint[0]
+
+#: Estimators that can be used by :func:`estimate`. The reference is
+#: ``puwr``.
+engines = {"puwr" : tauint,
+           "gamma" : gamma_method}
+
+def window_scan_label(label, d, arg_dict):
+    """Like :func:`window_scan`, but for the data of a single
+    label."""
+    S = np.arange(*arg_dict['S_range'])
+    print "* label:", label
+    for o in arg_dict["orders"]:
+        print "   * order:", o
+        mean, gamma = autocorrelation(d.data[o])
+        W, delta, tint, dtint = windows(gamma, d.data[o].size, S)
+        print "      {0:>6} {1:>6} {2:>16} {3:>16}"\
+            .format("S", "W", "mean", "tint")
+        for s, w, de, t, dt in zip(S, W, delta, tint, dtint):
+            print "      {0:6.2f} {1:6d} {2:>16} {3:>16}"\
+                .format(s, w, pretty_print(mean, de), pretty_print(t, dt))
+        if arg_dict['pdfname']:
+            fig = plt.figure()
+            pl = fig.add_subplot(211)
+            pl.errorbar(S, tint, yerr=dtint, fmt="bo")
+            pl.set_ylabel("$\\tau_{\\rm int}$")
+            pl = fig.add_subplot(212)
+            pl.plot(S, delta, "ro")
+            pl.set_xlabel("$S$")
+            pl.set_ylabel("$\\delta$")
+            plt.savefig(arg_dict['pdfname'].format(
+                    label = label.replace("/", "_"), order = o))
+            plt.close(fig)
+
+def window_scan(data, arg_dict):
+    """Check how the error estimate depends on the parameter
+    :math:`S` of the automatic windowing procedure. The
+    autocorrelation function is computed only once per label and
+    order. Optionally make a plot."""
+    for label in sorted(data.keys()):
+        window_scan_label(label, data[label], arg_dict)
+
+#: Actions that use :func:`estimate`.
+estimate_actions = ("show", "extrapolate")
+
+#: Actions that can work label by label, as soon as the data of a
+#: directory has been read. Maps the action name to the function
+#: processing a single label.
+label_actions = {"show" : show_label,
+                 "window_scan" : window_scan_label}
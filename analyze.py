@@ -13,25 +13,352 @@ the main script. It will
 2. Read all input data as specified in the configuration.
 
 3. Perform the action that are specified in the input.
+
+If all actions can work label by label (like ``show``), steps 2. and
+3. overlap: a background thread reads the next directories while the
+current one is analyzed. How far the reader may run ahead is limited
+by ``--prefetch`` (number of directories) and ``--mem-cap`` (size of
+the data in flight).
+
+With ``--mem-limit``, the memory needed to read each directory is
+estimated from the file sizes before anything is read, and each
+directory is read in one go, streamed chunk by chunk, or streamed into
+a memory-mapped scratch file (``--scratch``), whichever is the
+fastest within the limit. The plan and the actual peak memory are
+reported.
+
+Data files may be compressed with ``gzip`` (``.gz``) or ``xz``
+(``.xz``, needs the ``lzma`` module, or ``backports.lzma`` for python
+2). They are decompressed on the fly,
+the replica of a directory in parallel threads (``--threads``).
+
+For a first look at the data, ``--quick FRACTION`` analyzes only a
+fraction of each replicum, either every n-th measurement
+(``--quick-mode stride``) or the first measurements (``--quick-mode
+prefix``). Uncompressed files are memory-mapped, so only the pages
+needed are read. With ``--refine``, the analysis is then repeated
+with twice the fraction each time, until all data are used. Strides
+can only select fractions 1/n, so the fraction actually used is
+reported and stored with the results.
+
+The estimator used by ``show`` and ``extrapolate`` is selected with
+``--engine``, see :data:`actions.engines`. ``--verify`` compares it to
+the reference ``puwr.tauint`` for all (or, with ``--verify-sample``,
+some) labels and orders of the analysis, instead of running the
+actions, and exits with a non-zero status if they differ by more than
+the tolerances. The sample is different for each run, the seed used
+is printed and can be given with ``--verify-seed`` to repeat a run.
+
+With ``--schedule``, the analysis is run as a graph of tasks (see
+:mod:`scheduler`): reading the data of each directory, the estimates
+for each label and order, and the actions. Each estimate is computed
+only once, independent tasks run in parallel (``--threads``), and the
+output of the actions is printed in the order of the input file.
+Finished estimates are kept as checkpoints in ``--checkpoint-dir``
+until the analysis is complete, so an interrupted run continues where
+it stopped when it is started again.
+
+An analysis can be spread over several processes and hosts that share
+a file system. ``--publish QUEUE`` splits the estimates needed by the
+``show`` and ``extrapolate`` actions into work units, one per
+directory and order, and puts them into a work queue for the input
+file in the directory ``QUEUE`` (see :mod:`workqueue`). Any number
+of ``--worker QUEUE`` processes, started with the same input file on
+any host, claim and compute the units; ``--workers N`` starts ``N`` of them.
+Finally, ``--reduce QUEUE`` collects the results and runs the actions,
+which then find their estimates in the results store. Only this last
+step uses the results store: sqlite databases must not be shared by
+processes on different hosts.
 """
 import argparse
 import sys
+import random
+import itertools
+import functools
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
 # nasty workaround to enabple pdf plots
 if "--clplot" in sys.argv:
     import matplotlib
     matplotlib.use('agg')
-from xml_parser import parse_file
+from xml_parser import load_analysis, label_errors, ValidationError
+from store import ResultStore, make_key
+from workqueue import WorkQueue
+from scheduler import Graph, Checkpoints
+import multiprocessing
 import actions
 import numpy as np
 import os
+import struct
+import zlib
+import tempfile
+import resource
+import gzip
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # backport for python < 3.5
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def list_files(path):
+    """Sorted names of the files in the directory ``path``. Without
+    ``scandir``, finding out which entries are files needs a ``stat``
+    for each, so all names are returned, and :func:`find_files` checks
+    only those it selects."""
+    if scandir:
+        names = [e.name for e in scandir(path) if e.is_file()]
+    else:
+        names = os.listdir(path)
+    return sorted(names)
+
+def find_files(d, names = None):
+    """Find the data files in a directory, i.e. all files that have
+    ``d.fn_contains`` in their name.
+
+    :param d: :class:`parser.Directory` instance.
+    :param names: The result of :func:`list_files` for ``d.path``, if
+      known.
+    :returns: Sorted list of paths, one per replicum.
+    """
+    if names is None:
+        names = list_files(d.path)
+    files = [d.path + "/" + f for f in names if d.fn_contains in f]
+    if not scandir:
+        files = [f for f in files if os.path.isfile(f)]
+    return files
+
+def discover(directories, nthreads = 8):
+    """Expand the glob patterns in the paths of ``directories`` and
+    find the data files, using ``nthreads`` threads. Each directory is
+    listed only once, even if it holds several observables.
+
+    :param directories: :class:`parser.Directory` instances.
+    :returns: The expanded list of directories, with their ``files``
+      member set.
+    :raises: :class:`xml_parser.ValidationError` if a pattern matches
+      no directory, if a directory does not exist or has no data
+      files, if there are ``xz`` files but no ``lzma`` module, or if
+      the expanded directories have ambiguous labels, e.g. if two
+      patterns match the same directory.
+    """
+    pool = ThreadPool(nthreads)
+    try:
+        expansions = pool.map(lambda d: d.expand(), directories)
+        empty = ["'{0}' matches no directory".format(d.path)
+                 for d, e in zip(directories, expansions) if not e]
+        if empty:
+            raise ValidationError("\n".join(empty))
+        expanded = [e for d in expansions for e in d]
+        paths = sorted(set(d.path for d in expanded))
+        missing = ["'{0}' is not a directory".format(p)
+                   for p in paths if not os.path.isdir(p)]
+        if missing:
+            raise ValidationError("\n".join(missing))
+        names = dict(zip(paths, pool.map(list_files, paths)))
+        for d in expanded:
+            d.files = find_files(d, names[d.path])
+    finally:
+        pool.close()
+    errors = ["no file in '{0}' contains '{1}'".format(d.path,
+                                                       d.fn_contains)
+              for d in expanded if not d.files]
+    errors += ["can not read '{0}', install the lzma module".format(f)
+               for d in expanded for f in d.files
+               if openers.get(os.path.splitext(f)[1], open) is None]
+    errors += label_errors(expanded)
+    if errors:
+        raise ValidationError("\n".join(errors))
+    return expanded
+
+#: Decompressors for data files, by file name extension.
+openers = {".gz" : gzip.GzipFile,
+           ".xz" : lzma.LZMAFile if lzma else None}
+
+#: Exceptions raised by the decompressors for broken files. The
+#: ``gzip`` module of python 2 raises ``TypeError`` or ``struct.error``
+#: for truncated headers.
+decompress_errors = (IOError, EOFError, zlib.error, TypeError,
+                     struct.error) + ((lzma.LZMAError,) if lzma else ())
+
+class CorruptStream(Exception):
+    """Raised if a compressed data file can not be decompressed, e.g.
+    because it is truncated."""
+    pass
+
+def file_size(fn):
+    """Size of the (uncompressed) content of a data file, in
+    bytes. For compressed files, this is an estimate: for ``xz``
+    files a rough one, for ``gzip`` files the size stored in the
+    trailer, which is exact only for files of a single member below
+    4GB.
+
+    :param fn: File name.
+    """
+    ext = os.path.splitext(fn)[1]
+    size = os.path.getsize(fn)
+    if ext == ".gz" and size >= 4:
+        # the size modulo 2^32 is stored in the last four bytes
+        with open(fn, "rb") as f:
+            f.seek(-4, 2)
+            return struct.unpack("<I", f.read(4))[0]
+    if ext in openers:
+        return 4 * size
+    return size
+
+def file_stat(fn):
+    """``(absolute path, size, modification time)`` of a file, which
+    identifies it together with its content, e.g. for the checksums in
+    :class:`store.ResultStore`."""
+    return (os.path.abspath(fn), os.path.getsize(fn),
+            os.path.getmtime(fn))
+
+def read_chunks(fn, chunk = 2**22):
+    """Read a data file chunk by chunk. Compressed files are
+    decompressed on the fly.
+
+    :param fn: File name.
+    :param chunk: Size of the chunks, in bytes.
+    :returns: Generator of :class:`numpy.ndarray` of bytes.
+    :raises: :class:`CorruptStream` if a compressed file is broken,
+      :class:`DataError` if it can not be decompressed here.
+    """
+    ext = os.path.splitext(fn)[1]
+    if ext in openers and not openers[ext]:
+        raise DataError("Can not read '{0}', install the lzma module."\
+                            .format(fn))
+    with openers.get(ext, open)(fn, "rb") as f:
+        while True:
+            try:
+                block = f.read(chunk)
+            except decompress_errors as e:
+                if ext not in openers:
+                    raise
+                raise CorruptStream(str(e) or type(e).__name__)
+            if not block:
+                break
+            yield np.frombuffer(block, np.uint8)
+
+def read_file(fn, chunk = 2**22):
+    """Read a data file. Compressed files are decompressed on the
+    fly, chunk by chunk, into a buffer allocated from
+    :func:`file_size`.
+
+    :param fn: File name.
+    :param chunk: Size of the chunks to decompress, in bytes.
+    :returns: The content of the file, a :class:`numpy.ndarray` of
+      bytes.
+    """
+    if os.path.splitext(fn)[1] not in openers:
+        return np.fromfile(open(fn, "rb"), np.uint8)
+    buf = np.empty(file_size(fn), np.uint8)
+    n = 0
+    for block in read_chunks(fn, chunk):
+        if n + block.size > buf.size:
+            # estimate too small, grow the buffer
+            tmp = np.empty(max(2 * buf.size, n + block.size), np.uint8)
+            tmp[:n] = buf[:n]
+            buf = tmp
+        buf[n:n + block.size] = block
+        n += block.size
+    return buf[:n]
+
+def subsample(raw, ord, fraction, mode = "stride"):
+    """Select a fraction of the measurements in ``raw``.
+
+    :param raw: Flat array of measurements, ``ord`` values each.
+    :param fraction: Fraction of the measurements to keep.
+    :param mode: ``"stride"`` keeps every n-th measurement,
+      ``"prefix"`` the first ones.
+    """
+    rows = raw[:raw.size - raw.size % ord].reshape(-1, ord)
+    if mode == "prefix":
+        rows = rows[:max(2, int(fraction * len(rows)))]
+    else:
+        rows = rows[::max(1, int(round(1. / fraction)))]
+    return np.array(rows).ravel()
 
-class Data:
+def effective_fraction(fraction, mode = "stride"):
+    """The fraction of the measurements :func:`subsample` keeps for
+    ``fraction``. With ``"stride"``, this is 1/n for the stride n.
+
+    :param fraction: Fraction of the measurements asked for.
+    :param mode: ``"stride"`` or ``"prefix"``, see :func:`subsample`.
+    """
+    if mode == "prefix":
+        return min(1., fraction)
+    return 1. / max(1, int(round(1. / fraction)))
+
+#: With the ``truncate`` policy, replica shorter than this fraction of
+#: the longest one are dropped instead of cutting all to their length.
+truncate_fraction = 0.5
+
+class DataError(Exception):
+    """Raised if the data files of a directory are broken."""
+    pass
+
+class Data(object):
     """Read all data files from a directory. The information given in
-    the ``xml`` input will be stored in various data memebers.
+    the ``xml`` input will be stored in various data memebers. The
+    files are read on the first access to :attr:`data`, or by
+    :meth:`load`.
+
+    While the files are read, they are checked for trailing partial
+    records, non-finite values, replica too short for the
+    thermalization cut-off, corrupt compressed files and replica of
+    different lengths. What
+    happens to broken replica is decided by the directory's
+    ``on_error`` policy:
+
+    * ``abort`` raises a :class:`DataError`,
+
+    * ``truncate`` drops trailing partial records, cuts replica at the
+      first non-finite value and to the length of the shortest one,
+      unless that is less than :data:`truncate_fraction` of the
+      longest one: then the short replica are dropped,
+
+    * ``drop`` drops broken replica and those with a length different
+      from the most common one.
+
+    There are three strategies to read the files, see :func:`plan`:
+
+    * ``full`` reads each file at once, which is fast but needs about
+      three times the memory of the final data,
+
+    * ``stream`` reads the files chunk by chunk into the final array,
+
+    * ``mmap`` does the same, but the final array is memory-mapped to
+      a scratch file.
+
+    Only uncompressed files can be streamed, because the size of the
+    content of compressed files is not known in advance, see
+    :func:`file_size`.
+
+    The observables of a directory (see :func:`group`) are read
+    together: the first access to the data of one of them reads the
+    files of all, see :func:`load_group`.
 
     :param d: :class:`parser.Directory` instance.
+    :param nthreads: Number of threads reading the replica.
+    :param sample: If given, ``(fraction, mode)`` to read only a
+      sub-sample of the data, see :func:`subsample`.
+    :param store: :class:`store.ResultStore` to keep the checksums of
+      the files in, or ``None``.
+    :param strategy: ``"full"``, ``"stream"`` or ``"mmap"``.
+    :param scratch: Directory for the scratch files of ``mmap``.
     """
-    def __init__(self, d):
+    def __init__(self, d, nthreads = 1, sample = None, store = None,
+                 strategy = "full", scratch = None):
         #: perturbative order
         self.ord = d.order
         #: tau value (integration step size)
@@ -40,28 +367,830 @@ class Data:
         self.ncut = d.ntherm
         #: lattice size
         self.L = d.L
-        # determine data type
-        dt = np.complex if d.complex else np.float
-        files = [i for i in os.listdir(d.path) if d.fn_contains in i]
-        if d.se:
-            raw = [np.fromfile(open(d.path + "/" + f, "rb"), dt)\
-                       .byteswap().real[self.ncut*self.ord:]\
-                       *d.normalization
-                   for f in files]
+        #: observable, see :meth:`parser.Directory.split`
+        self.observable = d.observable
+        if d.files is None:
+            d.files = find_files(d)
+        #: checksums of the files, by file name
+        self.checksums = {}
+        self._directory = d
+        self._nthreads = nthreads
+        #: sub-sample of the data used, see :func:`subsample`
+        self.sample = sample
+        self._store = store
+        self._strategy = strategy
+        self._scratch = scratch
+        self._data = None
+        # read together with these, see group
+        self._group = None
+        # thread pool shared by the group while it is read
+        self._pool = None
+
+    @property
+    def signature(self):
+        """Identifies the input: the options for reading the files and
+        their checksums. If a checksum is not known from the store, the
+        files are read, unless only a sub-sample is used. In that case,
+        path, size and modification time of the file are used."""
+        d = self._directory
+        files = []
+        for f in d.files:
+            stat = file_stat(f)
+            if f not in self.checksums and self._store:
+                c = self._store.checksum(*stat)
+                if c:
+                    self.checksums[f] = c
+            if f not in self.checksums and not self.sample:
+                self.load()
+            files.append(self.checksums.get(f, stat))
+        return [d.normalization, d.se, d.complex, d.on_error, self.ncut,
+                self.ord, self.sample] + files
+
+    @property
+    def data(self):
+        """The data, an array of shape ``(ord, nrep, N)``."""
+        if self._data is None:
+            self.load()
+        return self._data
+
+    def load(self):
+        """Read and check the data files, and those of the other
+        observables of the directory."""
+        if self._data is not None:
+            return
+        pending = [d for d in self._group or [self] if d._data is None]
+        if len(pending) > 1:
+            load_group(pending)
+        else:
+            self._load()
+            self._leave_group()
+
+    def _leave_group(self):
+        # once read, leave the group, so that no reference cycles keep
+        # the data alive
+        if self._group:
+            self._group.remove(self)
+        self._group = None
+
+    def _load(self):
+        if self._strategy == "full" or self.sample:
+            self._load_full()
         else:
-            raw = [np.fromfile(open(d.path + "/" + f, "rb"), dt)\
-                       .real[self.ncut*self.ord:]\
-                       *d.normalization
-                   for f in files]
+            self._load_stream()
         #: number of replica
-        self.nrep = len(raw)
+        self.nrep = self._data.shape[1]
         #: number of data points / replicum / order
-        self.N = raw[0].size / self.ord
+        self.N = self._data.shape[2]
+
+    def _map(self, f, args):
+        """``map``, using :attr:`_nthreads` threads, or the pool of
+        the group."""
+        if self._pool:
+            return self._pool.map(f, args)
+        if self._nthreads > 1 and len(args) > 1:
+            pool = ThreadPool(min(self._nthreads, len(args)))
+            try:
+                return pool.map(f, args)
+            finally:
+                pool.close()
+        return [f(i) for i in args]
+
+    def _checksum(self, f, nbytes, adler):
+        """Record the (``adler32``) checksum of the file ``f``."""
+        self.checksums[f] = "adler32:{0}:{1:08x}"\
+            .format(nbytes, adler & 0xffffffff)
+        if self._store:
+            self._store.save_checksum(*file_stat(f) + (self.checksums[f],))
+
+    def _convert(self, rows):
+        """Byte-swap and normalize measurements, cut them at the first
+        non-finite value.
+
+        :param rows: Array of shape ``(n, ord)``, as read.
+        :returns: ``(values, first, counts)``, where ``first`` is the
+          index of the first measurement with non-finite values, or
+          ``None``, and ``counts`` is an array with the number of NaN
+          and infinite values in ``rows``.
+        """
+        d = self._directory
+        if d.se:
+            rows = rows.byteswap()
+        values = rows.real * d.normalization
+        finite = np.isfinite(values)
+        if finite.all():
+            return values, None, np.zeros(2, int)
+        nan = np.isnan(values).sum()
+        counts = np.array([nan, (~finite).sum() - nan])
+        first = (~finite.all(axis = 1)).argmax()
+        return values[:first], first, counts
+
+    @staticmethod
+    def _non_finite(first, counts):
+        """Problem report for non-finite values, see :meth:`_convert`."""
+        return "non-finite values from measurement {0} ({1} NaN, {2} " \
+            "infinite)".format(first, *counts)
+
+    def _select(self, replica):
+        """Apply the ``on_error`` policy.
+
+        :param replica: List of ``(file name, number of values,
+          problems)`` for each replicum.
+        :returns: ``(indices of the replica to keep, number of
+          values)``.
+        """
+        d = self._directory
+        keep = []
+        for i, (f, n, problems) in enumerate(replica):
+            if problems:
+                msg = "{0}: {1}".format(f, ", ".join(problems))
+                if d.on_error == "abort":
+                    raise DataError(msg)
+                if d.on_error == "drop" or not n:
+                    print "   ! dropping", msg
+                    continue
+                print "   ! truncating", msg
+            keep.append(i)
+        if not keep:
+            raise DataError("No usable data in " + d.path)
+        lengths = [replica[i][1] for i in keep]
+        if len(set(lengths)) == 1:
+            return keep, lengths[0]
+        msg = "{0}: replica lengths differ ({1} to {2} values)"\
+            .format(d.path, min(lengths), max(lengths))
+        if d.on_error == "abort":
+            raise DataError(msg)
+        if d.on_error == "truncate":
+            # drop replica so short that cutting the others to their
+            # length would discard most of the data
+            cut = truncate_fraction * max(lengths)
+            short = [i for i in keep if replica[i][1] < cut]
+            if short:
+                print "   ! dropping replica shorter than {0:.0%} of " \
+                    "the longest,".format(truncate_fraction), msg
+                for i in short:
+                    print "      dropping", replica[i][0]
+                keep = [i for i in keep if i not in short]
+                lengths = [replica[i][1] for i in keep]
+            n = min(lengths)
+            total = sum(lengths)
+            if total > n * len(keep):
+                print "   ! truncating, {0}: replica cut to {1} values, " \
+                    "discarding {2} of {3} ({4:.1%})".format(
+                    d.path, n, total - n * len(keep), total,
+                    1 - n * len(keep) / float(total))
+            return keep, n
+        print "   ! dropping short replica,", msg
+        common = max(set(lengths), key = lambda n: (lengths.count(n), n))
+        return [i for i in keep if replica[i][1] == common], common
+
+    def _load_full(self):
+        d, sample = self._directory, self.sample
+        # determine data type
+        dt = np.complex if d.complex else np.float
+        def read(f):
+            problems = []
+            # empty files can not be memory-mapped
+            if sample and os.path.splitext(f)[1] not in openers \
+                    and os.path.getsize(f):
+                raw = np.memmap(f, np.uint8, "r")
+            else:
+                try:
+                    raw = read_file(f)
+                except CorruptStream as e:
+                    return f, np.empty(0), \
+                        ["corrupt compressed stream ({0})".format(e)]
+                self._checksum(f, raw.nbytes, zlib.adler32(raw))
+            record = np.dtype(dt).itemsize * self.ord
+            if raw.size % record:
+                problems.append("trailing partial record")
+                raw = raw[:raw.size - raw.size % record]
+            raw = raw.view(dt)
+            if raw.size <= self.ncut*self.ord:
+                problems.append("shorter than thermalization cut-off")
+            raw = raw[self.ncut*self.ord:]
+            if sample:
+                raw = subsample(raw, self.ord, *sample)
+            raw, first, counts = self._convert(raw.reshape(-1, self.ord))
+            if first is not None:
+                problems.append(self._non_finite(first, counts))
+            return f, raw.ravel(), problems
+        replica = self._map(read, d.files)
+        keep, n = self._select([(f, r.size, p) for f, r, p in replica])
+        raw = [replica[i][1][:n] for i in keep]
+        nrep, N = len(raw), n / self.ord
         # the raw data
-        self.data = np.concatenate(raw)\
-            .reshape( self.nrep * self.N, self.ord )\
-            .transpose().reshape(self.ord, self.nrep, self.N)
-            
+        self._data = np.concatenate(raw)\
+            .reshape( nrep * N, self.ord )\
+            .transpose().reshape(self.ord, nrep, N)
+
+    def _load_stream(self):
+        d = self._directory
+        dt = np.complex if d.complex else np.float
+        record = np.dtype(dt).itemsize * self.ord
+        chunk = record * max(1, 2**22 / record)
+        N = max([file_size(f) / record - self.ncut for f in d.files] + [1])
+        shape = (self.ord, len(d.files), N)
+        if self._strategy == "mmap":
+            # deleted once the data is garbage collected
+            self._scratch_file = tempfile.TemporaryFile(
+                prefix = "parmalgt-", dir = self._scratch)
+            out = np.memmap(self._scratch_file, np.float, "w+",
+                            shape = shape)
+        else:
+            out = np.empty(shape)
+        def fill(i):
+            f = d.files[i]
+            adler, nbytes, nread, n, first = 1, 0, 0, 0, None
+            counts = np.zeros(2, int)
+            carry = np.empty(0, np.uint8)
+            try:
+                for block in read_chunks(f, chunk):
+                    adler = zlib.adler32(block, adler)
+                    nbytes += block.size
+                    if carry.size:
+                        block = np.concatenate((carry, block))
+                    usable = block.size - block.size % record
+                    carry = block[usable:]
+                    rows = block[:usable].view(dt).reshape(-1, self.ord)
+                    skip = max(0, self.ncut - nread)
+                    nread += len(rows)
+                    values, bad, c = self._convert(rows[skip:])
+                    counts += c
+                    if first is not None:
+                        # only the checksum and the counts are needed
+                        continue
+                    if n + len(values) > N:
+                        raise DataError("{0}: larger than expected"\
+                                            .format(f))
+                    out[:, i, n:n + len(values)] = values.T
+                    if bad is not None:
+                        first = n + bad
+                    n += len(values)
+            except CorruptStream as e:
+                return f, 0, ["corrupt compressed stream ({0})".format(e)]
+            self._checksum(f, nbytes, adler)
+            problems = []
+            if nbytes % record:
+                problems.append("trailing partial record")
+            if nbytes / record <= self.ncut:
+                problems.append("shorter than thermalization cut-off")
+            if first is not None:
+                problems.append(self._non_finite(first, counts))
+            return f, n * self.ord, problems
+        keep, n = self._select(self._map(fill, range(len(d.files))))
+        # move the replica to keep to the front
+        for j, i in enumerate(keep):
+            if i != j:
+                out[:, j, :] = out[:, i, :]
+        self._data = out[:, :len(keep), :n / self.ord]
+
+def group(datas):
+    """Group :class:`Data` instances by directory, so that the
+    observables of a directory are read together.
+
+    :returns: List of the groups, lists of :class:`Data` instances, in
+      the order of their first member in ``datas``.
+    """
+    groups = {}
+    for data in datas:
+        g = groups.setdefault(data._directory.path, [])
+        g.append(data)
+        data._group = g
+    return sorted(groups.values(), key = lambda g: datas.index(g[0]))
+
+def load_group(datas):
+    """Read the data of several :class:`Data` instances in one pass
+    over their files, using the number of threads of the first one in
+    total. Instances already read, e.g. for their
+    :attr:`Data.signature`, are not read again."""
+    for data in datas:
+        if data._data is not None:
+            data._leave_group()
+    datas = [data for data in datas if data._data is None]
+    if not datas:
+        return
+    pool = ThreadPool(datas[0]._nthreads)
+    errors = []
+    def load(data):
+        try:
+            data._load()
+        except:
+            errors.append(sys.exc_info())
+    try:
+        for data in datas:
+            data._pool = pool
+        threads = [threading.Thread(target = load, args = (data,))
+                   for data in datas]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        pool.close()
+        for data in datas:
+            data._pool = None
+            data._leave_group()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+def memory_estimate(d, nthreads = 1, chunk = 2**22):
+    """Estimate the memory needed to read the data of a directory.
+
+    :param d: :class:`parser.Directory` instance.
+    :param nthreads: Number of threads reading the replica.
+    :returns: Dictionary with the size of the final array (``"data"``)
+      and the estimated peak memory for each strategy of
+      :class:`Data`, in bytes.
+    """
+    if d.files is None:
+        d.files = find_files(d)
+    itemsize = 16 if d.complex else 8
+    sizes = [file_size(f) for f in d.files] or [0]
+    data = 8 * sum(max(0, s / itemsize - d.ntherm * d.order)
+                   for s in sizes)
+    nthreads = max(1, min(nthreads, len(sizes)))
+    # converted replica, concatenation, transposition and the files
+    # being read
+    chunk = min(chunk, max(sizes))
+    return {"data" : data,
+            "full" : 3 * data + nthreads * max(sizes),
+            "stream" : data + 3 * nthreads * chunk,
+            "mmap" : 3 * nthreads * chunk}
+
+def plan(directories, limit, nthreads = 1, resident = True):
+    """Choose a strategy for reading the data of each directory, see
+    :class:`Data`, so that the estimated peak memory stays below
+    ``limit``. The fastest strategy that fits is used, or the one
+    needing the least memory if none does. Directories that can not
+    be streamed are always read with ``full``. The observables of a
+    directory are read at the same time (see :func:`load_group`), so
+    they are planned together, with the same strategy.
+
+    :param directories: :class:`parser.Directory` instances.
+    :param limit: Memory limit, in bytes.
+    :param nthreads: Number of threads reading the replica.
+    :param resident: If ``True``, the data of all directories are kept
+      in memory at the same time, otherwise one at a time.
+    :returns: ``(strategies, peak)``, where ``strategies`` maps the
+      labels to ``(strategy, estimate)``, see
+      :func:`memory_estimate`, and ``peak`` is the estimated peak
+      memory.
+    """
+    groups = {}
+    for d in directories:
+        groups.setdefault(d.path, []).append(d)
+    strategies = {}
+    used = peak = 0
+    for g in sorted(groups.values(),
+                    key = lambda g: directories.index(g[0])):
+        members = []
+        for d in g:
+            e = memory_estimate(d, nthreads)
+            streamable = all(os.path.splitext(f)[1] not in openers
+                             for f in d.files)
+            members.append((d, e, streamable))
+        def need(s):
+            return sum(e[s if streamable else "full"]
+                       for d, e, streamable in members)
+        fits = [s for s in ("full", "stream", "mmap")
+                if used + need(s) <= limit]
+        s = fits[0] if fits else min(("full", "stream", "mmap"),
+                                      key = need)
+        for d, e, streamable in members:
+            strategies[d.label] = (s if streamable else "full", e)
+        peak = max(peak, used + need(s))
+        if resident:
+            used += sum(e["data"] for d, e, streamable in members
+                        if strategies[d.label][0] != "mmap")
+    return strategies, peak
+
+def data_size(d):
+    """Size of the data files in a directory, in bytes. This is an
+    upper bound for the memory the corresponding :class:`Data` will
+    occupy.
+
+    :param d: :class:`parser.Directory` instance.
+    """
+    if d.files is None:
+        d.files = find_files(d)
+    return sum(file_size(f) for f in d.files)
+
+def prefetch(directories, make_data = Data, depth = 2, mem_cap = None,
+             preload = None):
+    """Read the data from ``directories`` in a background thread and
+    yield ``(label, data)`` pairs in the order of ``directories``
+    while the next ones are being read. Consecutive directories with
+    the same path, i.e. the observables of a directory, are read
+    together.
+
+    :param directories: :class:`parser.Directory` instances.
+    :param make_data: Function creating the :class:`Data` instance
+      for a directory.
+    :param depth: Maximum number of directories read ahead, not
+      counting the other observables of a directory. Together with the
+      one being processed, at most ``depth + 1`` directories are in
+      memory.
+    :param mem_cap: Maximum size (in bytes) of the data read but not
+      yet processed. A single directory is always read, even if it
+      exceeds this limit.
+    :param preload: Function deciding if a :class:`Data` instance
+      should be read in the background. If it returns ``False``, the
+      data is read only if accessed.
+    """
+    queue = Queue.Queue()
+    # one slot for each directory read but not yet processed,
+    # including the one being read
+    slots = threading.Semaphore(max(0, depth) + 1)
+    lock = threading.Condition()
+    in_flight = [0]
+    def read():
+        try:
+            for path, ds in itertools.groupby(directories,
+                                              lambda d: d.path):
+                ds = list(ds)
+                sizes = [data_size(d) for d in ds]
+                slots.acquire()
+                with lock:
+                    while mem_cap and in_flight[0] \
+                            and in_flight[0] + sum(sizes) > mem_cap:
+                        lock.wait()
+                    in_flight[0] += sum(sizes)
+                datas = [make_data(d) for d in ds]
+                group(datas)
+                load = [preload is None or preload(d.label, data)
+                        for d, data in zip(ds, datas)]
+                load_group([data for data, l in zip(datas, load) if l])
+                for i, (d, data, size, l) in \
+                        enumerate(zip(ds, datas, sizes, load)):
+                    queue.put((d.label, data, size if l else 0,
+                               i == len(ds) - 1))
+                if not all(load):
+                    with lock:
+                        in_flight[0] -= sum(s for s, l in zip(sizes, load)
+                                            if not l)
+                        lock.notify()
+            queue.put(None)
+        except:
+            queue.put(sys.exc_info())
+    reader = threading.Thread(target = read)
+    reader.daemon = True
+    reader.start()
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        if isinstance(item[1], BaseException):
+            raise item[0], item[1], item[2]
+        label, data, size, last = item
+        del item
+        yield label, data
+        # the consumer is done with this directory
+        del data
+        with lock:
+            in_flight[0] -= size
+            lock.notify()
+        if last:
+            slots.release()
+
+def memory_plan(an, args, resident):
+    """Choose and print the strategies for reading the data within
+    ``args.mem_limit``, see :func:`plan`.
+
+    :param resident: If ``True``, the data of all directories are kept
+      in memory, otherwise those of ``args.prefetch`` directories
+      read ahead and the current one.
+    :returns: The strategies, by label.
+    """
+    limit = args.mem_limit * 2**20
+    # the directories read ahead and the current one, observables of
+    # a directory are read together
+    ndirs = len(set(d.path for d in an.directories))
+    n = 1 if resident else max(1, min(args.prefetch + 1, ndirs))
+    strategies, peak = plan(an.directories, limit / n, args.threads,
+                            resident)
+    peak *= n
+    print "* Memory plan (limit {0:.1f} MB):".format(args.mem_limit)
+    for label in sorted(strategies):
+        s, e = strategies[label]
+        print "   {0}: {1}, {2:.1f} MB data, {3:.1f} MB peak"\
+            .format(label, s, e["data"] / 2.**20, e[s] / 2.**20)
+    print "   estimated peak: {0:.1f} MB".format(peak / 2.**20)
+    if peak > limit:
+        print "   ! the estimated peak exceeds the limit"
+    return strategies
+
+def data_maker(an, args, resident, sample = None, results = None):
+    """Plan the reading of the data with ``args.mem_limit``, see
+    :func:`memory_plan`.
+
+    :param resident: See :func:`memory_plan`.
+    :param sample: Passed on to :class:`Data`.
+    :param results: Passed on to :class:`Data`.
+    :returns: A function creating the :class:`Data` instance for a
+      directory.
+    """
+    strategies = {}
+    if args.mem_limit and not sample:
+        strategies = memory_plan(an, args, resident)
+    def make_data(d):
+        strategy = strategies.get(d.label, ("full",))[0]
+        return Data(d, args.threads, sample, results, strategy,
+                    args.scratch)
+    return make_data
+
+def run_actions(an, args, sample = None, results = None):
+    """Read the data and perform the actions of an analysis.
+
+    :param an: :class:`xml_parser.Analysis` instance.
+    :param args: Parsed command line arguments.
+    :param sample: Passed on to :class:`Data`.
+    :param results: :class:`store.ResultStore` for the results, or
+      ``None``.
+    """
+    for action in an.actions:
+        action.kwargs.update(vars(args))
+        action.kwargs['store'] = results
+    if args.schedule:
+        return run_graph(an, args, sample, results)
+    pipeline = all(a.function in actions.label_actions
+                   for a in an.actions)
+    make_data = data_maker(an, args, not pipeline, sample, results)
+    if pipeline:
+        # overlap reading and analysis
+        mem_cap = args.mem_cap * 2**20 if args.mem_cap else None
+        directories = sorted(an.directories, key = lambda d: d.label)
+        def preload(label, d):
+            # no need to read the data if all results are known
+            return not all(a.function in actions.estimate_actions
+                           and actions.cached(label, d, o, a.kwargs)
+                           for a in an.actions for o in a.orders)
+        for label, d in prefetch(directories, make_data, args.prefetch,
+                                 mem_cap, preload):
+            for action in an.actions:
+                actions.label_actions[action.function]\
+                    (label, d, action.kwargs)
+            # free the data before the next directory is read
+            del d
+    else:
+        # read the data
+        data = {}
+        for directory in an.directories:
+            data[directory.label] = make_data(directory)
+        group([data[d.label] for d in an.directories])
+        for action in an.actions:
+            getattr(actions, action.function)\
+                (data, action.kwargs)
+
+def checkpoint_key(an, args, sample = None):
+    """Identifies the checkpoints of an analysis: the input file, the
+    estimator, the sub-sample and the data files."""
+    files = sorted(file_stat(f) for d in an.directories for f in d.files)
+    return make_key(an.digest, actions.settings(vars(args)), sample,
+                    files)
+
+def run_graph(an, args, sample = None, results = None):
+    """Like :func:`run_actions`, but run the analysis as a graph of
+    tasks, see :mod:`scheduler`. The data of each directory are read
+    and the estimates for each label and order are computed once, in
+    parallel. The actions run in the order of the input file, with the
+    estimates they need passed in ``kwargs['estimates']``.
+
+    If all actions only need estimates, the data of at most
+    ``args.prefetch`` + 1 directories are kept in memory at a time.
+    Otherwise all data are kept, and with ``args.mem_limit``, the
+    directories are read one at a time.
+
+    The estimates are kept as checkpoints in ``args.checkpoint_dir``
+    until all actions are done. Directories whose estimates are all in
+    the results store are not read.
+    """
+    directories = sorted(an.directories, key = lambda d: d.label)
+    kwargs = dict(vars(args), store = results)
+    resident = not all(a.function in actions.estimate_actions
+                       for a in an.actions)
+    make_data = data_maker(an, args, resident, sample, results)
+    reading = threading.Lock() if args.mem_limit and resident else None
+    def load(d):
+        data = make_data(d)
+        if reading is None:
+            data.load()
+        else:
+            with reading:
+                data.load()
+        return data
+    def perform(action, keys, *values):
+        if action.function in actions.estimate_actions:
+            # the data are needed only for tau and L
+            action.kwargs['estimates'] = dict(zip(keys, values))
+            data = dict((d.label, make_data(d)) for d in directories)
+        else:
+            data = dict(zip(keys, values))
+        getattr(actions, action.function)(data, action.kwargs)
+    graph = Graph()
+    orders = sorted(set(o for a in an.actions
+                        if a.function in actions.estimate_actions
+                        for o in a.orders))
+    for d in directories:
+        known = None
+        if not resident:
+            # no need to read the data if all results are known
+            data = make_data(d)
+            known = [actions.cached(d.label, data, o, kwargs)
+                     for o in orders]
+            del data
+        if known and all(r is not None for r in known):
+            for o, r in zip(orders, known):
+                graph.add("estimate {0} {1}".format(d.label, o),
+                          lambda r = r: r, checkpoint = False)
+            continue
+        graph.add("load " + d.label, lambda d = d: load(d),
+                  checkpoint = False, bounded = True)
+        for o in orders:
+            graph.add("estimate {0} {1}".format(d.label, o),
+                      lambda data, label = d.label, o = o:
+                          actions.estimate(label, data, o, kwargs),
+                      ["load " + d.label])
+    for i, action in enumerate(an.actions):
+        if action.function in actions.estimate_actions:
+            keys = [(d.label, o) for d in directories
+                    for o in action.orders]
+            deps = ["estimate {0} {1}".format(*k) for k in keys]
+        else:
+            keys = [d.label for d in directories]
+            deps = ["load " + k for k in keys]
+        graph.add("{0} {1}".format(i, action.function),
+                  functools.partial(perform, action, keys),
+                  deps, checkpoint = False, serial = True)
+    checkpoints = None
+    if args.checkpoint_dir:
+        checkpoints = Checkpoints(args.checkpoint_dir,
+                                  checkpoint_key(an, args, sample))
+    # matplotlib is not thread safe
+    nrun, nrestored = graph.run(1 if args.uwplot else args.threads,
+                                checkpoints, None if resident
+                                else max(0, args.prefetch) + 1)
+    if checkpoints:
+        checkpoints.remove()
+    print "* Scheduler: {0} tasks run, {1} restored from checkpoints"\
+        .format(nrun, nrestored)
+
+def verify(an, args):
+    """Compare the estimator ``args.engine`` to the reference
+    ``puwr.tauint`` on the labels and orders of an analysis.
+
+    :returns: ``True`` if all deviations are within the tolerances,
+      ``False`` if they are not or if there is nothing to compare.
+    """
+    orders = sorted(set(o for a in an.actions
+                        for o in getattr(a, 'orders', None) or []))
+    units = [(d.label, o) for d in an.directories for o in orders]
+    if not units:
+        print "* Nothing to verify: the actions use no orders."
+        return False
+    if args.verify_sample < 1:
+        seed = args.verify_seed
+        if seed is None:
+            # a different sample each run, e.g. for nightly checks
+            seed = random.SystemRandom().randint(0, 2**31 - 1)
+        print "* Verifying a sample of {0:.1%}, seed {1}"\
+            .format(args.verify_sample, seed)
+        units = random.Random(seed).sample(
+            units, max(1, int(args.verify_sample * len(units))))
+    labels = set(l for l, o in units)
+    directories = sorted((d for d in an.directories if d.label in labels),
+                         key = lambda d: d.label)
+    fast, reference = actions.engines[args.engine], actions.engines['puwr']
+    # largest deviations: (value, label, order) for mean, error, tint
+    worst = [(0, None, None)] * 3
+    make_data = lambda d: Data(d, args.threads)
+    for label, d in prefetch(directories, make_data, args.prefetch):
+        for o in sorted(o for l, o in units if l == label):
+            mean, delta, tint, dtint = fast(d.data, o)
+            rmean, rdelta, rtint, rdtint = reference(d.data, o)
+            # zero reference values give non-finite deviations
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                deviations = (abs(mean - rmean) / np.float64(rdelta),
+                              abs(delta / np.float64(rdelta) - 1),
+                              abs(tint / np.float64(rtint) - 1))
+            print "* {0}, order {1}: mean {2}, error {3}, tint {4}"\
+                .format(label, o, *("{0:.2e}".format(x)
+                                    for x in deviations))
+            # non-finite deviations are the worst
+            worst = [(x, label, o) if w[1] is None or np.isfinite(w[0])
+                     and (x > w[0] or not np.isfinite(x)) else w
+                     for w, x in zip(worst, deviations)]
+        del d
+    ok = True
+    print "* Largest deviations of '{0}' from 'puwr' ({1} of {2}):"\
+        .format(args.engine, len(units),
+                len(an.directories) * len(orders))
+    for name, unit, (x, label, o), tol in zip(
+        ("mean", "error", "tint"),
+        ("errors", "relative", "relative"), worst,
+        (args.tol_mean, args.tol_error, args.tol_tint)):
+        passed = np.isfinite(x) and x <= tol
+        status = "ok" if passed else "FAILED"
+        ok = ok and passed
+        print "   {0}: {1:.2e} ({2}, tolerance {3:.2e}) at {4}, order {5}"\
+            " -> {6}".format(name, x, unit, tol, label, o, status)
+    return ok
+
+def refine(an, args, results = None):
+    """Repeat the analysis with twice the fraction of the data each
+    time, starting from ``args.quick``, until all data are used.
+    Fractions that select the same measurements as the previous pass,
+    see :func:`effective_fraction`, are skipped."""
+    target = fraction = effective_fraction(args.quick, args.quick_mode)
+    while fraction < 1:
+        target *= 2
+        f = effective_fraction(min(1., target), args.quick_mode)
+        if f <= fraction:
+            continue
+        fraction = f
+        print "* Refining: {0:.1%} of the data".format(fraction)
+        run_actions(an, args, (fraction, args.quick_mode)
+                    if fraction < 1 else None, results)
+
+def run(an, args, results = None):
+    """Run the analysis, or a quick look at it, see ``--quick``.
+
+    :param an: :class:`xml_parser.Analysis` instance.
+    :param args: Parsed command line arguments.
+    :param results: :class:`store.ResultStore` for the results, or
+      ``None``.
+    """
+    fraction = effective_fraction(args.quick, args.quick_mode) \
+        if args.quick else 1
+    if fraction < 1:
+        print "* Quick look: {0:.1%} of the data".format(fraction)
+        run_actions(an, args, (fraction, args.quick_mode), results)
+        if args.refine:
+            refine(an, args, results)
+    else:
+        run_actions(an, args, results = results)
+
+def queue_path(an, path):
+    """The directory of the work queue of an analysis in the queue
+    directory ``path``. Each input file has its own queue, so that
+    units of different analyses never mix."""
+    return os.path.join(path, an.digest)
+
+def work_units(an):
+    """Split the estimates needed for an analysis into work units.
+
+    :returns: A dictionary mapping the names of the units to
+      ``{"label" : label, "order" : order}``.
+    """
+    orders = sorted(set(o for a in an.actions
+                        if a.function in actions.estimate_actions
+                        for o in a.orders))
+    return dict(("{0:06d}.{1:03d}".format(i, o),
+                 {"label" : d.label, "order" : o})
+                for i, d in enumerate(an.directories) for o in orders)
+
+def work(an, args, path):
+    """Worker process: claim and compute work units from the queue in
+    ``path`` until there are none left. The results, including the
+    checksums of the files, are passed on through the queue only, see
+    :func:`collect`."""
+    queue = WorkQueue(path)
+    directories = dict((d.label, d) for d in an.directories)
+    kwargs = dict(vars(args), store = None, uwplot = False)
+    data = {}
+    while True:
+        claimed = queue.claim()
+        if claimed is None:
+            break
+        name, unit = claimed
+        label = unit["label"]
+        if label not in data:
+            # units are sorted by directory, keep only one in memory
+            data = {label : Data(directories[label], args.threads)}
+        d = data[label]
+        result = actions.estimate(label, d, unit["order"], kwargs)
+        print "* {0}: {1}, order {2}".format(name, label, unit["order"])
+        sys.stdout.flush()
+        queue.complete(name, {
+                "label" : label, "order" : unit["order"],
+                "ntherm" : d.ncut, "settings" : actions.settings(kwargs),
+                "inputs" : d.signature,
+                "files" : [file_stat(f) + (d.checksums[f],)
+                           for f in d.checksums],
+                "result" : [float(r) for r in result]})
+
+def collect(path, results):
+    """Collect the results from the queue in ``path`` into the results
+    store ``results``."""
+    queue = WorkQueue(path)
+    pending = queue.pending()
+    if pending:
+        print "* {0} work units are not done, the actions will compute "\
+            "their estimates.".format(len(pending))
+    for r in queue.results().values():
+        for f in r["files"]:
+            results.save_checksum(*f)
+        results.save_estimate(r["label"], r["order"], r["ntherm"],
+                              r["settings"], r["inputs"], r["result"])
 
 ############################################################
 #
@@ -80,17 +1209,144 @@ if __name__ == "__main__":
                               '"show" or "extrapolate" are used in '
                               'the xml input.'), 
                         action='store_true')
+    # read-ahead for actions that work label by label
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help=('Number of directories to read ahead '
+                              'while the current one is analyzed '
+                              '(0: none).'))
+    parser.add_argument('--mem-cap', type=float, default=None,
+                        help=('Maximum amount of data (in MB) read '
+                              'ahead but not yet analyzed.'))
+    parser.add_argument('--mem-limit', type=float, default=None,
+                        help=('Memory limit (in MB). Choose how to '
+                              'read each directory so that the '
+                              'estimated peak memory stays below it.'))
+    parser.add_argument('--scratch', default=None,
+                        help=('Directory for memory-mapped data, see '
+                              '--mem-limit.'))
+    parser.add_argument('--threads', type=int, default=8,
+                        help=('Number of threads used to find and '
+                              'decompress the data.'))
+    parser.add_argument('--cache-dir', default='.parmalgt-cache',
+                        help='Directory for cached intermediate results.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not use or write cached results.')
+    # quick look
+    parser.add_argument('--quick', type=float, default=None,
+                        metavar='FRACTION',
+                        help=('Analyze only this fraction of the '
+                              'measurements in each replicum (with '
+                              'strides, the nearest 1/n).'))
+    parser.add_argument('--quick-mode', choices=('stride', 'prefix'),
+                        default='stride',
+                        help=('Take every n-th measurement (stride) '
+                              'or the first ones (prefix) with '
+                              '--quick.'))
+    parser.add_argument('--refine', action='store_true',
+                        help=('After --quick, refine the results '
+                              'until all data are used.'))
+    # estimators
+    parser.add_argument('--engine', choices=sorted(actions.engines),
+                        default='puwr',
+                        help='Estimator for show and extrapolate.')
+    parser.add_argument('--verify', action='store_true',
+                        help=('Compare the estimator selected with '
+                              '--engine to puwr instead of running the '
+                              'actions. Exits with status 1 if they '
+                              'differ.'))
+    parser.add_argument('--verify-sample', type=float, default=1.,
+                        metavar='FRACTION',
+                        help=('Verify only this fraction of the labels '
+                              'and orders.'))
+    parser.add_argument('--verify-seed', type=int, default=None,
+                        help=('Seed for choosing the sample of '
+                              '--verify-sample, default: random. The '
+                              'seed used is printed.'))
+    parser.add_argument('--tol-mean', type=float, default=1e-6,
+                        help=('Tolerance for the mean values, in units '
+                              'of the error.'))
+    parser.add_argument('--tol-error', type=float, default=0.01,
+                        help='Relative tolerance for the errors.')
+    parser.add_argument('--tol-tint', type=float, default=0.01,
+                        help=('Relative tolerance for the integrated '
+                              'autocorrelation times.'))
+    # task graph
+    parser.add_argument('--schedule', action='store_true',
+                        help=('Run the analysis as a graph of tasks, '
+                              'in parallel and with checkpoints.'))
+    parser.add_argument('--checkpoint-dir', default=None,
+                        help=('Directory for the checkpoints of '
+                              '--schedule, default: checkpoints in '
+                              'the cache directory.'))
+    # distributed analysis
+    queue_mode = parser.add_mutually_exclusive_group()
+    queue_mode.add_argument('--publish', metavar='QUEUE',
+                            help=('Publish work units to the work queue '
+                                  'in the directory QUEUE and exit.'))
+    queue_mode.add_argument('--worker', metavar='QUEUE',
+                            help=('Compute work units from the work '
+                                  'queue in the directory QUEUE.'))
+    queue_mode.add_argument('--reduce', metavar='QUEUE',
+                            help=('Collect the results from the work '
+                                  'queue in the directory QUEUE and run '
+                                  'the actions.'))
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes for --worker.')
     # parse command line arguments
     args = parser.parse_args()
+    if args.quick is not None and not 0 < args.quick <= 1:
+        parser.error("--quick: the fraction must be in (0, 1].")
+    cache_dir = None if args.no_cache else args.cache_dir
+    if args.checkpoint_dir is None and cache_dir:
+        args.checkpoint_dir = os.path.join(cache_dir, "checkpoints")
     # parse input file -> analysis object
-    an =  parse_file(args.file)
+    try:
+        an = load_analysis(args.file, cache_dir)
+    except ValidationError as e:
+        sys.exit("Invalid input file {0}:\n{1}".format(args.file.name, e))
     # print info on analysis object
     an.info()
-    # read the data
-    data = {}
-    for directory in an.directories:
-        data[directory.label] = Data(directory)
-    for action in an.actions:
-        action.kwargs.update(vars(args))
-        getattr(actions, action.function)\
-            (data, action.kwargs)
+    # find the data files
+    try:
+        an.directories = discover(an.directories, args.threads)
+    except ValidationError as e:
+        sys.exit("Invalid input file {0}:\n{1}".format(args.file.name, e))
+    if args.verify:
+        if args.engine == "puwr":
+            sys.exit("Select the estimator to verify with --engine.")
+        try:
+            sys.exit(0 if verify(an, args) else 1)
+        except DataError as e:
+            sys.exit("Broken data: {0}".format(e))
+    if args.publish:
+        n = WorkQueue(queue_path(an, args.publish))\
+            .publish(work_units(an))
+        print "* Published {0} work units.".format(n)
+        sys.exit()
+    if args.worker:
+        workers = [multiprocessing.Process(
+                target = work,
+                args = (an, args, queue_path(an, args.worker)))
+                   for i in range(args.workers)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        sys.exit(max(w.exitcode for w in workers))
+    # results of previous runs
+    results = ResultStore(os.path.join(cache_dir, "results.sqlite")) \
+        if cache_dir else None
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        if args.reduce:
+            if results is None:
+                results = ResultStore(":memory:")
+            collect(queue_path(an, args.reduce), results)
+        run(an, args, results)
+    except DataError as e:
+        sys.exit("Broken data: {0}".format(e))
+    if args.mem_limit:
+        # ru_maxrss is in kB on Linux
+        print "* Peak memory: {0:.1f} MB ({1:.1f} MB before the analysis)"\
+            .format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                    / 2.**10, base / 2.**10)
@@ -0,0 +1,231 @@
+"""
+:mod:`scheduler` -- task graphs with checkpoints
+==================================================
+
+.. module: scheduler
+
+A small scheduler for graphs of tasks. Each task is a function that
+is called with the results of the tasks it depends on. Tasks whose
+dependencies are done run concurrently in a thread pool, except for
+``serial`` tasks, which run one after the other in the calling thread,
+in the order they were added. This is meant for tasks that print
+results.
+
+The results of finished tasks can be kept as checkpoints, pickle files
+in a directory (see :class:`Checkpoints`). If a run is interrupted,
+the next one restores these results instead of running the tasks
+again, and it skips tasks that are only needed by restored ones::
+
+  >>> import tempfile
+  >>> path = tempfile.mkdtemp()
+  >>> graph = Graph()
+  >>> graph.add("a", lambda: 2)
+  >>> graph.add("b", lambda a: a**10, ["a"])
+  >>> graph.add("show", lambda b: sys.stdout.write(str(b) + "\\n"),
+  ...           ["b"], checkpoint = False, serial = True)
+  >>> graph.run(4, Checkpoints(path, "example"))
+  1024
+  (3, 0)
+  >>> shutil.rmtree(path)
+"""
+import cPickle as pickle
+import hashlib
+import os
+import shutil
+import sys
+import Queue
+from multiprocessing.pool import ThreadPool
+from workqueue import atomic_open, make_dirs
+
+class Checkpoints(object):
+    """Results of finished tasks, one pickle file per task in the
+    directory ``path/key``.
+
+    :param path: Directory for the checkpoints.
+    :param key: Identifies the computation the tasks belong to, e.g. a
+      hash of the input. Checkpoints with a different key are never
+      used.
+    """
+    def __init__(self, path, key):
+        self.path = os.path.join(path, key)
+        make_dirs(self.path)
+
+    def filename(self, name):
+        """File name of the checkpoint of the task ``name``."""
+        return os.path.join(self.path,
+                            hashlib.sha1(name).hexdigest() + ".pickle")
+
+    def __contains__(self, name):
+        return os.path.isfile(self.filename(name))
+
+    def load(self, name):
+        """The result of the task ``name``."""
+        with open(self.filename(name), "rb") as f:
+            return pickle.load(f)
+
+    def save(self, name, result):
+        """Keep the ``result`` of the task ``name``. The file is
+        written to a temporary name first, so an interrupted run never
+        leaves a partial checkpoint."""
+        with atomic_open(self.filename(name), "wb") as f:
+            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+
+    def remove(self):
+        """Remove the checkpoints, e.g. once all tasks are done."""
+        shutil.rmtree(self.path, ignore_errors = True)
+
+class Task(object):
+    """A node of a :class:`Graph`, see :meth:`Graph.add`."""
+    def __init__(self, name, function, deps, checkpoint, serial,
+                 bounded):
+        self.name = name
+        self.function = function
+        self.deps = list(deps)
+        self.checkpoint = checkpoint
+        self.serial = serial
+        self.bounded = bounded
+        #: Names of the tasks depending on this one.
+        self.dependents = []
+
+class Graph(object):
+    """Graph of tasks."""
+    def __init__(self):
+        #: Tasks, by name.
+        self.tasks = {}
+        #: Names of the tasks, in the order they were added.
+        self.order = []
+
+    def add(self, name, function, deps = (), checkpoint = True,
+            serial = False, bounded = False):
+        """Add a task. Tasks have to be added after the tasks they
+        depend on.
+
+        :param name: Unique name of the task.
+        :param function: Function to call with the results of
+          ``deps``.
+        :param deps: Names of the tasks this one depends on.
+        :param checkpoint: Keep the result as a checkpoint? The result
+          has to be picklable then.
+        :param serial: Run the task in the calling thread, after the
+          serial tasks added before it.
+        :param bounded: Count the task against ``max_live``, see
+          :meth:`run`. Must not be ``serial``.
+        """
+        if name in self.tasks:
+            raise ValueError("Duplicate task '{0}'.".format(name))
+        for d in deps:
+            if d not in self.tasks:
+                raise ValueError("Task '{0}' depends on unknown task "
+                                 "'{1}'.".format(name, d))
+            self.tasks[d].dependents.append(name)
+        self.tasks[name] = Task(name, function, deps, checkpoint, serial,
+                                bounded)
+        self.order.append(name)
+
+    def plan(self, checkpoints = None):
+        """Decide which tasks have to run.
+
+        :returns: ``(run, restore)``, the names of the tasks to run
+          and of those to restore from ``checkpoints``.
+        """
+        done = set(n for n in self.order if checkpoints is not None
+                   and self.tasks[n].checkpoint and n in checkpoints)
+        run = set()
+        for name in reversed(self.order):
+            t = self.tasks[name]
+            # a task is needed if nothing depends on it, or a task
+            # that runs does
+            if name not in done and (not t.dependents or
+                                     run.intersection(t.dependents)):
+                run.add(name)
+        restore = set(d for n in run for d in self.tasks[n].deps
+                      if d in done)
+        return run, restore
+
+    def run(self, nthreads = 1, checkpoints = None, max_live = None):
+        """Run the tasks, using ``nthreads`` threads for those that
+        are not ``serial``. If a task fails, the tasks already running
+        are finished, and the exception is raised again.
+
+        :param checkpoints: :class:`Checkpoints` instance, or ``None``.
+        :param max_live: Maximum number of ``bounded`` tasks running
+          or holding results that are still needed, e.g. to limit the
+          memory used by large results. ``None`` means no limit.
+        :returns: The number of tasks run and restored.
+        """
+        run, restore = self.plan(checkpoints)
+        results = dict((n, checkpoints.load(n)) for n in restore)
+        # number of tasks still waiting for the result of each task
+        users = dict((n, len([d for d in self.tasks[n].dependents
+                              if d in run]))
+                     for n in run | restore)
+        waiting = [n for n in self.order if n in run]
+        finished = Queue.Queue()
+        pool = ThreadPool(max(1, nthreads))
+        running = 0
+        # bounded tasks running or with results in use
+        live = [0]
+        error = None
+        def call(name):
+            try:
+                t = self.tasks[name]
+                result = t.function(*[results[d] for d in t.deps])
+                if checkpoints is not None and t.checkpoint:
+                    checkpoints.save(name, result)
+                finished.put((name, result, None))
+            except:
+                finished.put((name, None, sys.exc_info()))
+        def free(name):
+            # free the memory as early as possible
+            del results[name]
+            if self.tasks[name].bounded and name in run:
+                live[0] -= 1
+        def done(name, result, exc_info):
+            if exc_info:
+                return exc_info
+            results[name] = result
+            for d in self.tasks[name].deps:
+                users[d] -= 1
+                if not users[d]:
+                    free(d)
+            if not users[name]:
+                free(name)
+        try:
+            while waiting or running:
+                ready = [n for n in waiting
+                         if all(d in results for d in self.tasks[n].deps)]
+                if error is None:
+                    for n in ready:
+                        t = self.tasks[n]
+                        if t.serial:
+                            continue
+                        if t.bounded:
+                            if max_live is not None and live[0] >= max_live:
+                                continue
+                            live[0] += 1
+                        waiting.remove(n)
+                        pool.apply_async(call, (n,))
+                        running += 1
+                    serial = [n for n in waiting if self.tasks[n].serial]
+                    if serial and serial[0] in ready:
+                        waiting.remove(serial[0])
+                        call(serial[0])
+                        running += 1
+                if not running:
+                    break
+                while True:
+                    # with a timeout, so that ^C works
+                    try:
+                        item = finished.get(True, 0.5)
+                        break
+                    except Queue.Empty:
+                        pass
+                running -= 1
+                error = error or done(*item)
+        finally:
+            pool.close()
+        if error:
+            raise error[0], error[1], error[2]
+        if waiting:
+            raise ValueError("Could not run tasks " + ", ".join(waiting))
+        return len(run), len(restore)
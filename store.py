@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+"""
+:mod:`store` -- persistent results
+====================================
+
+.. module: store
+
+The results of the actions are kept in an ``sqlite`` data base, so
+that they do not have to be computed again as long as the input data
+and the settings do not change. This module only uses the python
+standard library, so the results can be queried without NumPy, SciPy
+or matplotlib, either from python (here with an empty data base in
+memory instead of ``.parmalgt-cache/results.sqlite``)::
+
+  >>> from store import ResultStore
+  >>> results = ResultStore(":memory:")
+  >>> puwr = {"estimator" : "puwr.tauint"}
+  >>> results.save_estimate("t.005", 2, 10, puwr, ["input"],
+  ...                       (1.5, .1, 5., .5))
+  >>> for r in results.estimates(label = "t.005"):
+  ...     print r["order"], r["mean"], r["delta"]
+  2 1.5 0.1
+
+or from the command line::
+
+  $ ./store.py .parmalgt-cache/results.sqlite --label t.005
+
+Results obtained from a sub-sample of the data (``--quick``) are kept
+apart from those for all data, and only the latter are shown unless
+``--all`` is given::
+
+  >>> results.save_estimate("t.005", 2, 10, puwr, ["input"],
+  ...                       (1.4, .3, 4., .8), [.5, "stride"])
+  >>> [r["mean"] for r in results.estimates("t.005")]
+  [1.5]
+  >>> for r in results.estimates("t.005", full = False):
+  ...     print r["mean"], describe(r)
+  1.5 puwr.tauint
+  1.4 puwr.tauint, 50.0% of the data (stride)
+
+For each label, order and estimator, only the results for the current
+input data are kept::
+
+  >>> results.save_estimate("t.005", 2, 10, puwr, ["new input"],
+  ...                       (1.6, .1, 5., .5))
+  >>> results.estimate("t.005", 2, 10, puwr, ["input"]) is None
+  True
+  >>> for r in results.estimates("t.005", full = False):
+  ...     print r["mean"], r["inputs"], describe(r)
+  1.4 [u'input'] puwr.tauint, 50.0% of the data (stride)
+  1.6 [u'new input'] puwr.tauint
+
+The same holds for the extrapolations of a set of labels::
+
+  >>> for cl, inputs in (1., ["a", "b"]), (2., ["new a", "b"]):
+  ...     results.save_extrapolation(2, 8, ["a", "b"], [1, 2], [3, 4],
+  ...                                [.1, .1], [cl, 1.], [.04, .01],
+  ...                                [[0], [cl]], puwr, None, inputs)
+  >>> for r in results.extrapolations(2):
+  ...     print r["L"], r["cl"], r["dcl"], r["inputs"]
+  8 2.0 0.2 [u'new a', u'b']
+"""
+import sqlite3
+import json
+import hashlib
+import threading
+import argparse
+import os
+
+#: Columns holding JSON data.
+json_columns = set(["settings", "sample", "inputs", "labels", "x", "y",
+                    "dy", "coefficients", "errors", "fit"])
+
+#: Version of the data base layout. Older data bases are cleared.
+version = 1
+
+def make_key(*args):
+    """Hash the (JSON-serializable) arguments into a key."""
+    return hashlib.sha1(json.dumps(args, sort_keys = True)).hexdigest()
+
+def to_json(obj):
+    """JSON representation for the data base, ``None`` for ``None``,
+    so that ``IS NULL`` works."""
+    return None if obj is None else json.dumps(obj, sort_keys = True)
+
+class ResultStore(object):
+    """Data base of estimates (mean, error, integrated
+    autocorrelation time and its error) per label and order, and of
+    the :math:`\\tau \\to 0` extrapolations.
+
+    :param filename: Name of the ``sqlite`` file, created if
+      necessary.
+    """
+    def __init__(self, filename):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # the store is shared between threads, see lock
+        self.db = sqlite3.connect(filename, check_same_thread = False)
+        self.db.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            if self.db.execute("PRAGMA user_version").fetchone()[0] \
+                    < version:
+                # only cached results are lost
+                self.db.executescript("""
+                  DROP TABLE IF EXISTS estimates;
+                  DROP TABLE IF EXISTS extrapolations;
+                  PRAGMA user_version = {0};""".format(version))
+            self.db.executescript("""
+              CREATE TABLE IF NOT EXISTS estimates (
+                key TEXT PRIMARY KEY, label TEXT, ord INTEGER,
+                ntherm INTEGER, settings TEXT, sample TEXT, inputs TEXT,
+                mean REAL, delta REAL, tint REAL, dtint REAL);
+              CREATE INDEX IF NOT EXISTS estimates_label
+                ON estimates (label, ord);
+              CREATE TABLE IF NOT EXISTS extrapolations (
+                key TEXT PRIMARY KEY, ord INTEGER, L INTEGER,
+                labels TEXT, settings TEXT, sample TEXT, inputs TEXT,
+                x TEXT, y TEXT, dy TEXT,
+                coefficients TEXT, errors TEXT, fit TEXT,
+                cl REAL, dcl REAL);
+              CREATE INDEX IF NOT EXISTS extrapolations_order
+                ON extrapolations (ord, L);
+              CREATE TABLE IF NOT EXISTS files (
+                path TEXT, size INTEGER, mtime REAL, checksum TEXT,
+                PRIMARY KEY (path, size, mtime));
+              """)
+
+    def checksum(self, path, size, mtime):
+        """Look up the checksum of a data file.
+
+        :param path: Absolute path of the file.
+        :param size: Size of the file.
+        :param mtime: Modification time of the file.
+        :returns: The checksum, or ``None`` if the file is unknown or
+          has changed.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT checksum FROM files WHERE path = ? AND size = ? "
+                "AND mtime = ?", (path, size, mtime)).fetchone()
+        return row[0] if row else None
+
+    def save_checksum(self, path, size, mtime, checksum):
+        """Store the checksum of a data file, the arguments are as for
+        :meth:`checksum`."""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+            self.db.execute("INSERT INTO files VALUES (?, ?, ?, ?)",
+                            (path, size, mtime, checksum))
+
+    def estimate(self, label, order, ntherm, settings, inputs,
+                 sample = None):
+        """Look up an estimate.
+
+        :param label: Label of the data.
+        :param order: Perturbative order.
+        :param ntherm: Thermalization cut-off.
+        :param settings: Dictionary of estimator settings.
+        :param inputs: Signature of the input data, see
+          :attr:`analyze.Data.signature`.
+        :param sample: Sub-sample of the data used, see
+          :class:`analyze.Data`, or ``None`` for all data.
+        :returns: ``(mean, delta, tint, dtint)`` or ``None``.
+        """
+        key = make_key(label, order, ntherm, settings, inputs, sample)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT mean, delta, tint, dtint FROM estimates "
+                "WHERE key = ?", (key,)).fetchone()
+        return tuple(row) if row else None
+
+    def save_estimate(self, label, order, ntherm, settings, inputs,
+                      result, sample = None):
+        """Store an estimate, the arguments are as for
+        :meth:`estimate`, ``result`` is ``(mean, delta, tint,
+        dtint)``. Estimates of the same sub-sample for other input
+        data are replaced.
+        """
+        key = make_key(label, order, ntherm, settings, inputs, sample)
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM estimates WHERE label = ? AND ord = ? AND "
+                "ntherm = ? AND settings = ? AND sample IS ?",
+                (label, order, ntherm, to_json(settings),
+                 to_json(sample)))
+            self.db.execute(
+                "INSERT OR REPLACE INTO estimates VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, label, order, ntherm, to_json(settings),
+                 to_json(sample), to_json(inputs))
+                + tuple(float(r) for r in result))
+
+    def save_extrapolation(self, order, L, labels, x, y, dy,
+                           coefficients, errors, fit, settings = None,
+                           sample = None, inputs = None):
+        """Store a :math:`\\tau \\to 0` extrapolation. Extrapolations
+        of the same labels for other input data are replaced.
+
+        :param order: Perturbative order.
+        :param L: Lattice size.
+        :param labels: Labels of the data points.
+        :param x: :math:`\\tau` values.
+        :param y: Mean values.
+        :param dy: Errors of the mean values.
+        :param coefficients: Fit coefficients, the first one is the
+          continuum limit.
+        :param errors: Squared errors of the coefficients.
+        :param fit: ``(x, y)`` values of the fit curve.
+        :param settings: Estimator settings.
+        :param sample: Sub-sample of the data used.
+        :param inputs: Signatures of the input data of the labels.
+        """
+        values = [[float(i) for i in v]
+                  for v in (x, y, dy, coefficients, errors)]
+        fit = [[float(i) for i in v] for v in fit]
+        key = make_key(order, L, labels, settings, sample, inputs)
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM extrapolations WHERE ord = ? AND L = ? AND "
+                "labels = ? AND settings IS ? AND sample IS ?",
+                (order, L, to_json(labels), to_json(settings),
+                 to_json(sample)))
+            self.db.execute(
+                "INSERT OR REPLACE INTO extrapolations VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [key, order, L, to_json(labels), to_json(settings),
+                 to_json(sample), to_json(inputs)] +
+                [json.dumps(v) for v in values] +
+                [json.dumps(fit), values[3][0], values[4][0]**0.5])
+
+    def query(self, table, full = False, **where):
+        """Select rows from ``table``, e.g. ``query("estimates",
+        label = "t.005")``. ``None`` values are ignored, the
+        :data:`json_columns` are decoded.
+
+        :param full: Only results for all data, not for a sub-sample?
+        :returns: List of dictionaries.
+        """
+        where = dict((k, v) for k, v in where.items() if v is not None)
+        conditions = [k + " = ?" for k in where]
+        if full:
+            conditions.append("sample IS NULL")
+        sql = "SELECT * FROM " + table
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        with self.lock:
+            rows = self.db.execute(sql + " ORDER BY rowid",
+                                   where.values()).fetchall()
+        result = []
+        for row in rows:
+            r = dict(zip(row.keys(), row))
+            for k in json_columns.intersection(r):
+                r[k] = r[k] if r[k] is None else json.loads(r[k])
+            r["order"] = r.pop("ord")
+            result.append(r)
+        return result
+
+    def estimates(self, label = None, order = None, full = True):
+        """Stored estimates, optionally only for ``label`` and
+        ``order``. If ``full``, only those for all data are
+        returned."""
+        return self.query("estimates", full, label = label, ord = order)
+
+    def extrapolations(self, order = None, L = None, full = True):
+        """Stored extrapolations, optionally only for ``order`` and
+        ``L``. If ``full``, only those for all data are returned."""
+        return self.query("extrapolations", full, ord = order, L = L)
+
+def describe(r):
+    """Estimator and sub-sample of a result, as a string."""
+    s = r["settings"]["estimator"] if r["settings"] else "?"
+    if r["sample"]:
+        s += ", {0:.1%} of the data ({1})".format(*r["sample"])
+    return s
+
+############################################################
+#
+#  main
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description = "Show stored results of parmalgt analyses.")
+    parser.add_argument('file', help='results data base')
+    parser.add_argument('--label', help='show only this label')
+    parser.add_argument('--order', type=int, help='show only this order')
+    parser.add_argument('--L', type=int,
+                        help='show only extrapolations for this L')
+    parser.add_argument('--all', action='store_true',
+                        help=('show also results for sub-samples of '
+                              'the data'))
+    args = parser.parse_args()
+    results = ResultStore(args.file)
+    full = not args.all
+    print "* Estimates"
+    for r in results.estimates(args.label, args.order, full):
+        print ("   {0} order {1} ntherm {2}: {3} +- {4}, tint {5} +- {6}"
+               " [{7}]").format(r["label"], r["order"], r["ntherm"],
+                                r["mean"], r["delta"], r["tint"],
+                                r["dtint"], describe(r))
+    if args.label is None:
+        print "* Extrapolations"
+        for r in results.extrapolations(args.order, args.L, full):
+            print "   order {0} L {1} ({2}): {3} +- {4} [{5}]"\
+                .format(r["order"], r["L"], ", ".join(r["labels"]),
+                        r["cl"], r["dcl"], describe(r))
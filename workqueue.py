@@ -0,0 +1,150 @@
+"""
+:mod:`workqueue` -- work queue on a shared file system
+========================================================
+
+.. module: workqueue
+
+A minimal work queue that lives in a directory on a file system shared
+by all hosts taking part in an analysis. It relies only on ``rename``
+being atomic, which also holds for NFS. The queue directory contains
+
+* ``todo/``: published work units, one JSON file each,
+
+* ``claimed/``: units a worker is working on. A worker claims a unit
+  by renaming it from ``todo/`` to ``claimed/``; if two workers try
+  this at the same time, only one of them succeeds.
+
+* ``done/``: the results, one JSON file per unit.
+
+Files are always written to a temporary name first and then renamed,
+so readers never see partial files. A unit goes from ``todo/`` over
+``claimed/`` to ``done/``::
+
+  >>> import shutil, tempfile
+  >>> path = tempfile.mkdtemp()
+  >>> queue = WorkQueue(path)
+  >>> queue.publish({"a" : 2, "b" : 3})
+  2
+  >>> name, unit = queue.claim()
+  >>> name, unit
+  ('a', 2)
+  >>> queue.complete(name, unit**10)
+  >>> sorted(queue.pending()), queue.results()
+  (['b'], {'a': 1024})
+
+If a worker crashes, its unit stays claimed. Publishing the units
+again puts it back into ``todo/``, but skips the units that are done
+or still waiting::
+
+  >>> queue.claim()
+  ('b', 3)
+  >>> queue.publish({"a" : 2, "b" : 3})
+  1
+  >>> queue.claim()
+  ('b', 3)
+  >>> queue.claim() is None
+  True
+  >>> shutil.rmtree(path)
+"""
+import json
+import os
+import socket
+import contextlib
+
+def make_dirs(path):
+    """Create the directory ``path`` and its parents, unless it
+    exists. Several processes may try this at the same time."""
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # created by another process in the meantime
+            if not os.path.isdir(path):
+                raise
+
+@contextlib.contextmanager
+def atomic_open(fn, mode = "w"):
+    """Open a temporary file to write, and rename it to ``fn`` once
+    it is closed without an error. Readers never see a partial file,
+    even if several processes on different hosts write ``fn``."""
+    tmp = "{0}.{1}.{2}.tmp".format(fn, socket.gethostname(), os.getpid())
+    with open(tmp, mode) as f:
+        yield f
+    os.rename(tmp, fn)
+
+def write_json(fn, obj):
+    """Atomically write ``obj`` to the file ``fn``."""
+    with atomic_open(fn) as f:
+        json.dump(obj, f)
+
+def read_json(fn):
+    with open(fn) as f:
+        return json.load(f)
+
+class WorkQueue(object):
+    """Work queue in the directory ``path``, which is created if
+    necessary."""
+    def __init__(self, path):
+        self.path = path
+        self.todo, self.claimed, self.done = \
+            [os.path.join(path, d) for d in ("todo", "claimed", "done")]
+        for d in self.todo, self.claimed, self.done:
+            make_dirs(d)
+        #: Suffix of the units claimed by this process.
+        self.me = ".{0}.{1}".format(socket.gethostname(), os.getpid())
+
+    def names(self, d):
+        """Names of the units in the sub-directory ``d``."""
+        return set(f[:f.index(".json")] for f in os.listdir(d)
+                   if ".json" in f and not f.endswith(".tmp"))
+
+    def publish(self, units):
+        """Publish work units. Units that are done or waiting to be
+        claimed are skipped. Claimed units that are not done are
+        published again, so re-publishing recovers from crashed
+        workers.
+
+        :param units: Dictionary mapping the names of the units to
+          JSON-serializable descriptions.
+        :returns: The number of units published.
+        """
+        skip = self.names(self.done) | self.names(self.todo)
+        n = 0
+        for name, unit in sorted(units.items()):
+            if name not in skip:
+                write_json(os.path.join(self.todo, name + ".json"), unit)
+                n += 1
+        return n
+
+    def claim(self):
+        """Claim a unit.
+
+        :returns: ``(name, unit)``, or ``None`` if there is nothing
+          left to do.
+        """
+        for name in sorted(self.names(self.todo)):
+            mine = os.path.join(self.claimed, name + ".json" + self.me)
+            try:
+                os.rename(os.path.join(self.todo, name + ".json"), mine)
+            except OSError:
+                # claimed by someone else
+                continue
+            return name, read_json(mine)
+        return None
+
+    def complete(self, name, result):
+        """Store the ``result`` of the unit ``name`` claimed before."""
+        write_json(os.path.join(self.done, name + ".json"), result)
+        os.remove(os.path.join(self.claimed, name + ".json" + self.me))
+
+    def pending(self):
+        """Names of the units that are not done yet."""
+        return (self.names(self.todo) | self.names(self.claimed)) \
+            - self.names(self.done)
+
+    def results(self):
+        """The results of all units done, as a dictionary mapping the
+        name of the unit to the result."""
+        return dict((name, read_json(os.path.join(self.done,
+                                                  name + ".json")))
+                    for name in self.names(self.done))
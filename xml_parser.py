@@ -19,7 +19,15 @@ Quick ``xml`` overview.
     one data files in a directory, they are considered to be
     replica. Each <directory> tag contains
 
-    - A <path> tag where the path to the data files is given.
+    - A <path> tag where the path to the data files is given. The
+      path may contain the glob patterns ``*``, ``?`` and ``[...]``
+      as well as the placeholders ``{tau}`` and ``{L}``, which match
+      like ``*`` and set <tauval> and <Lval> from the matched
+      directory name. Such a <directory> is expanded into one
+      directory per match, e.g. ``data/L{L}/t{tau}`` matches
+      ``data/L8/t0.005`` with :math:`L/a = 8` and :math:`\tau_g =
+      0.005`. It is an error if a pattern matches no directory, or a
+      placeholder something that is not a number.
   
     - A <tauval> tag that contains the value for the integrator step size
       :math:`\tau_g`.
@@ -43,8 +51,21 @@ Quick ``xml`` overview.
     - A <label> tag that will label the data in the analysis (can be
       omitted).
 
+    - An <on_error> tag that tells the code what to do with broken
+      data files (partial records, non-finite values, replica that
+      are too short or differ in length): ``abort`` (the default),
+      ``truncate`` or ``drop``, see :class:`analyze.Data`.
+
+    - <observable> tags, if the directory contains the data of
+      several observables, e.g. ``<observable name="plaq"
+      filenamecontains="Gp" normalization="0.05" max_order="5"/>``.
+      The files are then found only once and read in one pass, but
+      each observable is analyzed separately with the label
+      ``label/name``. ``filenamecontains`` defaults to the name,
+      ``normalization`` and ``max_order`` to those of the directory.
+
   * Each analysis may contain one or more <action> tags. At the
-    moment, there are three actions defined:
+    moment, there are four actions defined:
 
       - <show> Just prints out the mean values, estimated
         autocorrelation time and the estimated errors thereof.
@@ -56,6 +77,12 @@ Quick ``xml`` overview.
         thermalization cut-off to allow the user to estimate the time
         the simulation needs to thermalize.
 
+      - <window_scan> shows (and optionally plots) the estimated
+        error and autocorrelation time for a range of the parameter
+        :math:`S` of the automatic windowing procedure, e.g.
+        ``<window_scan orders="2" S="0.5 4 0.25"
+        pdfname="ws_{label}_{order}.pdf"/>``.
+
 
 Minimalist example
 =======================
@@ -94,36 +121,57 @@ The following example shows the parser at work::
   >>> analysis.actions[0].function
   'show'
 
+The whole analysis description is checked when the parse is done, so
+errors like a missing attribute or an order beyond <max_order> are
+reported as a :class:`ValidationError` before any data is read.
+
 Don't forget to check out the examples in the sub-directory
 ``example`` of the source tree.
 """
 import xml.sax.handler
+import cPickle as pickle
+import hashlib
+from StringIO import StringIO
 import os
 import fnmatch
 import copy
-import sys
+import glob
+import re
+from workqueue import atomic_open, make_dirs
+
+class ValidationError(Exception):
+    """Raised if the analysis description is invalid."""
+    pass
+
+#: Known tags, maps the (lower case) tag name to the class.
+tags = {}
+
+def tag(cls):
+    """Class decorator to register ``cls`` for the tag with the same
+    name. This means, to make the parser understand the tag <my-tag>,
+    it is enough to define the class My-tag (capitalization does not
+    matter), have it inherit from Node to add some convenience
+    functions and decorate it with ``@tag``."""
+    tags[cls.__name__.lower()] = cls
+    return cls
 
 def create_element(name, parent, attrs):
     """Create an element of the process.  This is done by
-    instantiating the object with corresponding name. This means, to
-    make ``jekyll`` understand the tag <my-tag>, it is enough to
-    define the class My-tag (note capitalization) in this namespace
-    and have it inherit from Node to add some convenience functions.
+    instantiating the class registered for the tag, see :func:`tag`.
 
-    :param name: Name of the tag encountered. Should match the name of
-                 the object to be created.
+    :param name: Name of the tag encountered.
     :type name: str.
 
     :param parent: The parent object (usually derived from
                    :class:`Node`).
     :type parent:  Class
     """
-    name = name.lower().capitalize() # get the capitalization right
     try:
-        tmp = eval(name)(attrs)
-    except NameError as e:
-        print "Encountered undefined tag '{}'.".format(name.upper())
-        sys.exit()
+        cls = tags[name.lower()]
+    except KeyError:
+        raise ValidationError("Encountered undefined tag '{0}'."\
+                                  .format(name.upper()))
+    tmp = cls(attrs)
     tmp.parent = parent
     return tmp
 
@@ -161,6 +209,7 @@ class Node(object):
     example, you can implement you own ``xml`` tag that communicates
     with the process that it is associated with like that::
 
+      @tag
       class foo(Node):
         # make parent aware of its foo
         def __init__(self):
@@ -173,6 +222,7 @@ class Node(object):
     between the opening and the closing tag in its ``buffer``
     member. To access it, you would proceed like this::
 
+      @tag
       class bar(Node):
         # tell parent to which bar to go
         def finalize(self):
@@ -207,6 +257,7 @@ class Node(object):
         obj.parent = None
         obj.children = []
         obj.opts = {}
+        obj.errors = []
         return obj
     def characters(self, data):
         """Default characters method, just buffer them. This is what
@@ -217,7 +268,70 @@ class Node(object):
         :type data: str.
         """
         self.buffer += data
-    
+
+    def value(self, type, text = None):
+        """Convert ``text`` (default: the buffer) to ``type``. If this
+        fails, an error is recorded for :meth:`validate` and ``None``
+        is returned."""
+        text = self.buffer.strip() if text is None else text.strip()
+        try:
+            return type(text)
+        except ValueError:
+            self.errors.append("<{0}>: can not convert '{1}' to {2}."\
+                                   .format(tagname(self), text,
+                                           type.__name__))
+
+    def attr_list(self, attrs, name, type = int, required = True,
+                  length = None):
+        """Read the attribute ``name`` as a white-space separated list
+        of values of type ``type``, of ``length`` values if
+        given. Errors are recorded for :meth:`validate`."""
+        text = attrs.get(name)
+        if text is None:
+            if required:
+                self.errors.append("<{0}>: missing attribute '{1}'."\
+                                       .format(tagname(self), name))
+            return None
+        values = [self.value(type, i) for i in text.split()]
+        if length is not None and len(values) != length:
+            self.errors.append(("<{0}>: attribute '{1}' needs {2} "
+                                "values, got '{3}'.")\
+                                   .format(tagname(self), name, length,
+                                           text))
+            return None
+        return None if None in values else values
+
+    def check(self):
+        """Check the element once the parse is done. Return a list of
+        error messages, empty if everything is fine. Override this to
+        validate your own tags."""
+        return []
+
+    def validate(self):
+        """Collect the errors of this element and all of its
+        children."""
+        errors = self.errors + self.check()
+        for c in self.children:
+            errors += c.validate()
+        return errors
+
+def label_errors(directories):
+    """Check that the labels of ``directories`` are unambiguous.
+
+    :returns: List of error messages.
+    """
+    errors = []
+    labels = set()
+    for d in directories:
+        if d.label in labels:
+            errors.append(("Found ambiguos label '{0}'! "
+                           "Labels must be unambiguous! You can "
+                           "omit the <label> tag and let me choose "
+                           "one for you.").format(d.label))
+        labels.add(d.label)
+    return errors
+
+@tag
 class Analysis(Node):
     def __init__(self, attrs):
         self.directories = []
@@ -237,12 +351,16 @@ class Analysis(Node):
         for d in self.directories:
             print "      Label:", d.label
             print "       Path:", d.path
-            print "        Tau:", d.tauval
-            print "          L:", d.L
+            print "        Tau:", d.from_path('tauval', 'tau')
+            print "          L:", d.from_path('L', 'L')
             print "     endian: " + ("swap" if d.se else "keep")
             print "  data type: " + "complex" if d.complex else "double"
             print "      therm:", d.ntherm
-            print "      order:", d.order
+            print "      order:", getattr(d, 'order', None)
+            print "   on error:", d.on_error
+            if d.observables:
+                print "observables:", ", ".join(o.name
+                                                for o in d.observables)
             print "   " + "*"*50
         print "* Actions:"
         for a in self.actions:
@@ -252,10 +370,69 @@ class Analysis(Node):
     def add_directory(self, dir):
         self.directories.append(dir)
 
+    def check(self):
+        errors = []
+        if not self.directories:
+            errors.append("<analysis>: no <directory> given.")
+        directories = [o for d in self.directories for o in d.split()]
+        errors += label_errors(directories)
+        # are the requested orders available?
+        max_order = min([getattr(d, 'order', None) or 0
+                         for d in directories] or [0])
+        for a in self.actions:
+            for o in getattr(a, 'orders', None) or []:
+                if not 0 <= o < max_order:
+                    errors.append(("<{0}>: order {1} not available, "
+                                   "<max_order> is {2}.")\
+                                      .format(a.function, o, max_order))
+        return errors
+
+    def validate(self):
+        errors = Node.validate(self)
+        if errors:
+            raise ValidationError("\n".join(errors))
+
+@tag
 class Max_order(Node):
     def finalize(self):
-        self.parent.order = int(self.buffer.strip())
+        self.parent.order = self.value(int)
+
+#: Placeholders in a <path> template.
+placeholder = re.compile(r"\{(tau|L)\}")
 
+def path_regex(template):
+    """Translate a <path> template into a regular expression. Glob
+    patterns match as in :mod:`glob`, placeholders become named
+    groups.
+
+    :param template: The path, possibly with glob patterns and
+      placeholders.
+    :type template: str.
+    """
+    rx = ""
+    seen = set()
+    for i, part in enumerate(placeholder.split(template)):
+        if i % 2:
+            # placeholder
+            if part in seen:
+                rx += "(?P={0})".format(part)
+            else:
+                rx += "(?P<{0}>[^/]+)".format(part)
+                seen.add(part)
+            continue
+        # literal part, may contain glob patterns
+        for c in re.split(r"(\[[^]]+\]|\*|\?)", part):
+            if c == "*":
+                rx += "[^/]*"
+            elif c == "?":
+                rx += "[^/]"
+            elif c.startswith("[") and c.endswith("]") and len(c) > 2:
+                rx += "[^" + c[2:] if c[1] == "!" else c
+            else:
+                rx += re.escape(c)
+    return re.compile(rx + "$")
+
+@tag
 class Directory(Node):
     """Directory to read data from."""
     def __init__(self, attrs):
@@ -264,7 +441,9 @@ class Directory(Node):
         #: Switch endianness?
         self.se = False
         #: Integration step size.
-        self.tauval = 0.0
+        self.tauval = None
+        #: Lattice size.
+        self.L = None
         self.label = False
         #: Complex data?
         self.complex = False
@@ -272,68 +451,191 @@ class Directory(Node):
         self.normalization = 1.0
         #: Filter for file names.
         self.fn_contains = ""
+        #: Data files, filled in by :func:`analyze.discover`.
+        self.files = None
+        #: What to do with broken data files.
+        self.on_error = "abort"
+        #: <observable> tags.
+        self.observables = []
+        #: Name of the observable, see :meth:`split`.
+        self.observable = None
     def finalize(self):
         if not self.label:
             self.label = self.path
         self.parent.add_directory(self)
 
-class LabelError(Exception):
-  pass
+    def expand(self):
+        """Expand glob patterns and placeholders in the path.
 
+        :returns: A list of :class:`Directory` objects, one for each
+          matching directory, sorted by path, and for each observable,
+          see :meth:`split`. If the path is a plain path and there are
+          no observables, this is ``[self]``.
+        :raises: :class:`ValidationError` if a placeholder matches
+          something that is not a number.
+        """
+        pattern = placeholder.sub("*", self.path.rstrip("/"))
+        if not glob.has_magic(pattern):
+            return self.split()
+        rx = path_regex(self.path.rstrip("/"))
+        # user-given labels are used as prefix
+        prefix = "" if self.label == self.path else self.label + ":"
+        result, errors = [], []
+        for path in sorted(glob.glob(pattern)):
+            m = rx.match(path)
+            if not m or not os.path.isdir(path):
+                continue
+            d = copy.copy(self)
+            d.path = path
+            d.label = prefix + path
+            values = m.groupdict()
+            for p, member, convert in (('tau', 'tauval', float),
+                                       ('L', 'L', int)):
+                if p not in values:
+                    continue
+                try:
+                    setattr(d, member, convert(values[p]))
+                except ValueError:
+                    errors.append("'{0}' matches '{1}', but {{{2}}} = "
+                                  "'{3}' is not a number".format(
+                            path, self.path, p, values[p]))
+            result.append(d)
+        if errors:
+            raise ValidationError("\n".join(errors))
+        return [o for d in result for o in d.split()]
+
+    def from_path(self, member, p):
+        """The value of ``member``, or ``"from path"`` if it is set by
+        the placeholder ``{p}`` in the path, see :meth:`expand`."""
+        value = getattr(self, member)
+        if value is None and "{" + p + "}" in self.path:
+            return "from path"
+        return value
+
+    def split(self):
+        """Split the directory into its observables.
+
+        :returns: A list of :class:`Directory` objects, one for each
+          <observable>, labelled ``label/name``. If there are no
+          observables, this is ``[self]``.
+        """
+        if not self.observables:
+            return [self]
+        result = []
+        for o in self.observables:
+            d = copy.copy(self)
+            d.observables = []
+            d.observable = o.name
+            d.label = "{0}/{1}".format(self.label, o.name)
+            d.fn_contains = o.fn_contains
+            if o.normalization is not None:
+                d.normalization = o.normalization
+            if o.order is not None:
+                d.order = o.order
+            result.append(d)
+        return result
+
+    def check(self):
+        errors = []
+        name = "<directory> '{0}': ".format(self.label)
+        if not self.path:
+            errors.append(name + "no <path> given.")
+        required = [('ntherm', 'ntherm', None),
+                    ('order', 'max_order', None)]
+        # tau and L are used only to extrapolate
+        if any(a.function == "extrapolate" for a in self.parent.actions):
+            required += [('tauval', 'tauval', 'tau'), ('L', 'Lval', 'L')]
+        for member, t, p in required:
+            if all(getattr(d, member, None) is not None
+                   for d in self.split()):
+                continue
+            if p is None or "{" + p + "}" not in self.path:
+                errors.append(name + "no <{0}> given.".format(t))
+        return errors
+
+@tag
 class Label(Node):
-    used = []
     def finalize(self):
       self.parent.label = self.buffer.strip()
-      if self.parent.label in Label.used:
-        errstr = ("Found ambiguos label '{0}'!\n"
-                  "Labels must be unambiguous!\n"
-                  "You can omit the <label> tag and let me choose one for you.")\
-                  .format(self.parent.label)
-        raise LabelError(errstr)
-      Label.used.append(self.parent.label)
 
+@tag
 class Path(Node):
     def finalize(self):
         self.parent.path = self.buffer.strip()
         
+@tag
 class Tauval(Node):
     def finalize(self):
-        self.parent.tauval = float(self.buffer.strip())
+        self.parent.tauval = self.value(float)
 
+@tag
 class Lval(Node):
     def finalize(self):
-        self.parent.L = int(self.buffer.strip())
+        self.parent.L = self.value(int)
 
+@tag
 class Swap_endian(Node):
     def finalize(self):
         self.parent.se = True
 
+@tag
 class Complex(Node):
     def finalize(self):
         self.parent.complex = True
 
+@tag
 class Ntherm(Node):
     def finalize(self):
-        self.parent.ntherm = int(self.buffer.strip())
+        self.parent.ntherm = self.value(int)
 
+@tag
 class Normalization(Node):
     def finalize(self):
-        self.parent.normalization = float(self.buffer.strip())
+        self.parent.normalization = self.value(float)
 
+@tag
 class Filenamecontains(Node):
     def finalize(self):
         self.parent.fn_contains = self.buffer.strip()
 
+@tag
+class Observable(Node):
+    def __init__(self, attrs):
+        self.name = attrs.get('name')
+        if not self.name:
+            self.errors.append("<observable>: missing attribute 'name'.")
+        self.fn_contains = attrs.get('filenamecontains', self.name)
+        self.normalization = self.value(float, attrs['normalization']) \
+            if 'normalization' in attrs else None
+        self.order = self.value(int, attrs['max_order']) \
+            if 'max_order' in attrs else None
+    def finalize(self):
+        self.parent.observables.append(self)
+
+@tag
+class On_error(Node):
+    policies = ("abort", "truncate", "drop")
+    def check(self):
+        if self.buffer.strip() not in self.policies:
+            return ["<on_error>: unknown policy '{0}', use one of {1}."\
+                        .format(self.buffer.strip(),
+                                ", ".join(self.policies))]
+        return []
+    def finalize(self):
+        self.parent.on_error = self.buffer.strip()
+
+@tag
 class Actions(Node):
     def __init__(self, attrs):
         self.actions = []
     def finalize(self):
         self.parent.actions = self.actions
 
+@tag
 class Show(Node):
     def __init__(self, attrs):
         # orders (for info string and attributes for function call)
-        self.orders = [int(i) for i in attrs.get('orders').split()]
+        self.orders = self.attr_list(attrs, 'orders')
         # function rom actions.py to call
         self.function = "show"
         # arguments for call
@@ -344,20 +646,23 @@ class Show(Node):
     def finalize(self):
         self.parent.actions.append(self)
 
+@tag
 class Extrapolate(Node):
     def __init__(self, attrs):
         # orders (for info string and attributes for function call)
-        self.orders = [int(i) for i in attrs.get('orders').split()]
-        if attrs.get('L'):
-            self.L = [int(i) for i in attrs.get('L').split()]
-        else:
-            self.L = None
+        self.orders = self.attr_list(attrs, 'orders')
+        self.L = self.attr_list(attrs, 'L', required = False)
         self.plots = []
         # function from actions.py to call
         self.function = "extrapolate"
     def __str__(self):
         return "  --> extrapolate (tau -> 0)\n      orders = " \
             + ", ".join(str(i) for i in self.orders)
+    def check(self):
+        return ["<plot> '{0}': order {1} is not extrapolated."\
+                    .format(p.pdfname, o)
+                for p in self.plots for o in p.orders or []
+                if o not in (self.orders or [])]
     def finalize(self):
         # arguments for call
         self.kwargs = {'orders' : self.orders,
@@ -365,51 +670,129 @@ class Extrapolate(Node):
                        'mk_plots' : self.plots}
         self.parent.actions.append(self)
 
+@tag
 class Plot(Node):
     def __init__(self, attrs):
         self.data = []
         self.cl = []
         self.fit = []
         self.labels = []
-        self.L = [int(i) for i in attrs.get('L').split()]
-        self.orders = [int(i) for i in attrs.get('orders').split()]
+        self.L = self.attr_list(attrs, 'L')
+        self.orders = self.attr_list(attrs, 'orders')
         self.pdfname = attrs.get('pdfname')
-        if attrs.get('known'):
-            self.known = [float(i) for i in attrs.get('known').split()]
-        else:
-            self.known = []
+        if not self.pdfname:
+            self.errors.append("<plot>: missing attribute 'pdfname'.")
+        self.known = self.attr_list(attrs, 'known', float,
+                                    required = False) or []
         self.ylabel = attrs.get("ylabel") if attrs.get("ylabel") else ""
     def finalize(self):
         self.parent.plots.append(self)
 
+@tag
 class Therm(Node):
     def __init__(self, attrs):
-        self.orders = [int(i) for i in attrs.get('orders').split()]
+        self.orders = self.attr_list(attrs, 'orders')
         self.start, self.end, self.step = \
-            [int(i) for i in attrs.get('range').split()]
+            self.attr_list(attrs, 'range', length = 3) or (0, 0, 1)
         self.function = "therm"
     def __str__(self):
         return ("  --> check thermalization effects\n"
                 "      cut-off from {0} to {1} in steps of {2}\n")\
                 .format(self.start, self.end, self.step)
+    def check(self):
+        # a malformed range is reported already
+        if not self.errors and (self.step <= 0 or self.end <= self.start):
+            return ["<therm>: empty cut-off range {0} {1} {2}."\
+                        .format(self.start, self.end, self.step)]
+        return []
     def finalize(self):
         self.kwargs = {'orders' : self.orders,
                        'cutoffs' : range(self.start, self.end,
                                          self.step)}
         self.parent.actions.append(self)
 
+@tag
+class Window_scan(Node):
+    def __init__(self, attrs):
+        self.orders = self.attr_list(attrs, 'orders')
+        self.start, self.end, self.step = \
+            self.attr_list(attrs, 'S', float, required = False,
+                           length = 3) \
+            or (0.5, 4., 0.25)
+        self.pdfname = attrs.get('pdfname')
+        self.function = "window_scan"
+    def __str__(self):
+        return ("  --> scan windowing parameter\n"
+                "      S from {0} to {1} in steps of {2}\n")\
+                .format(self.start, self.end, self.step)
+    def check(self):
+        if self.step <= 0 or self.end <= self.start:
+            return ["<window_scan>: empty S range {0} {1} {2}."\
+                        .format(self.start, self.end, self.step)]
+        return []
+    def finalize(self):
+        self.kwargs = {'orders' : self.orders,
+                       'S_range' : (self.start, self.end, self.step),
+                       'pdfname' : self.pdfname}
+        self.parent.actions.append(self)
+
 def parse_file(f):
     """Parse an entire ``xml`` file.
 
     :param name: Name of the ``xml`` file to parse.
     :name type: str.
     :returns: The :class:`Project` object resulting from the parse.
+    :raises: :class:`ValidationError` if the file is not well-formed
+      or the analysis is invalid.
     """
     # Create the handler
     handler = Root(f)
     parser = xml.sax.make_parser()
     # Parse the input
     parser.setContentHandler(handler)
-    parser.parse(f)
+    try:
+        parser.parse(f)
+    except xml.sax.SAXParseException as e:
+        raise ValidationError("line {0}, column {1}: {2}".format(
+                e.getLineNumber(), e.getColumnNumber(), e.getMessage()))
+    handler.run.validate()
     return handler.run
 
+def load_analysis(f, cache_dir = None):
+    """Like :func:`parse_file`, but keep the parsed analysis in
+    ``cache_dir``. An unchanged input file is not parsed again. There
+    is one cache file per input file, replaced when the input changes.
+
+    :param f: Open ``xml`` input file.
+    :param cache_dir: Cache directory, ``None`` to disable caching.
+    """
+    content = f.read()
+    # identifies the input, e.g. for checkpoints
+    digest = hashlib.sha1(content).hexdigest()
+    if not cache_dir:
+        an = parse_file(StringIO(content))
+        an.digest = digest
+        return an
+    # the cache depends on the input and on this module
+    key = hashlib.sha1(content)
+    key.update(str(os.path.getmtime(__file__)))
+    key = key.hexdigest()
+    path = os.path.abspath(getattr(f, "name", "<input>"))
+    fn = os.path.join(cache_dir, "analysis." + hashlib.sha1(path).hexdigest())
+    try:
+        with open(fn, "rb") as cached:
+            cached_key, an = pickle.load(cached)
+        if cached_key == key:
+            return an
+    except (IOError, EOFError, ValueError, TypeError,
+            pickle.UnpicklingError):
+        pass
+    an = parse_file(StringIO(content))
+    an.digest = digest
+    # detach from the sax handler
+    an.parent = None
+    # several processes may share the cache, e.g. workers
+    make_dirs(cache_dir)
+    with atomic_open(fn, "wb") as cached:
+        pickle.dump((key, an), cached, pickle.HIGHEST_PROTOCOL)
+    return an